@@ -6,17 +6,18 @@
 #
 # Reads the mapping file written by import-github-issues.py.
 #
+# the current titles are listed from github a page of issues at a time, and
+# only the issues whose titles need changing are updated.
+#
 
 import argparse
+import concurrent.futures
 import logging
-import os
-import os.path
-import re
 import yaml
 
-import requests
-
 import common
+import issue_store
+import mapping_db
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
@@ -30,42 +31,105 @@ parser.add_argument(
     '--data-dir', default='data',
     help='destination directory for exported issues. (default: %(default)s)'
 )
+parser.add_argument(
+    '--concurrency', type=int, default=4,
+    help='maximum number of issues to update at once. (default: %(default)s)'
+)
 args = parser.parse_args()
 
 if args.debug:
     logging.getLogger().setLevel(logging.DEBUG)
 
 with open('config.yaml') as conf:
-    config = yaml.load(conf)
+    config = yaml.safe_load(conf)
+
+issue_mapping = mapping_db.open_mapping_db(args.data_dir)
+store = issue_store.open_issue_store(args.data_dir)
+
+github_session = common.get_github_session(
+    config, pool_size=max(10, args.concurrency),
+)
+
+
+def get_titles(issue_paths):
+    """get the current titles of some github issues
 
-mapping_file = os.path.join(args.data_dir, 'issue_mapping.yaml')
-with open(mapping_file) as f:
-    issue_mapping = yaml.load(f)
+    Takes a list of 'user/proj/issues/N' paths, and returns a map from path
+    to title. If there are only a few issues, we fetch them one by one;
+    otherwise we list all the issues in their repositories, 100 at a time.
+    """
+    titles = {}
+    repos = sorted(set(p.split('/issues/')[0] for p in issue_paths))
+    if len(issue_paths) <= len(repos) * 10:
+        for p in issue_paths:
+            resp = github_session.get('https://api.github.com/repos/' + p)
+            resp.raise_for_status()
+            titles[p] = resp.json()['title']
+        return titles
+
+    wanted = set(issue_paths)
+    for repo in repos:
+        logger.info("Listing issues in %s", repo)
+        for issue in github_session.paginate(
+            'https://api.github.com/repos/%s/issues' % repo,
+            {'state': 'all'},
+        ):
+            p = '%s/issues/%i' % (repo, issue['number'])
+            if p in wanted:
+                titles[p] = issue['title']
+    return titles
+
+
+def update_title(issue_jira_key, title):
+    logger.info("Updating %s", issue_jira_key)
+    resp = github_session.patch(
+        'https://api.github.com/repos/' + issue_mapping[issue_jira_key],
+        json={'title': title},
+    )
+    resp.raise_for_status()
 
-github_session = requests.Session()
-github_session.headers.update({
-    'User-Agent': 'Jira issue import',
-    'Authorization': 'token ' + config['github_token'],
-})
 
 issues = args.issue
 if issues is None:
     issues = sorted(issue_mapping.keys(), key=common.sort_jira_key)
 
-for issue_jira_key in issues:
-    logger.info("Updating %s", issue_jira_key)
-    fname = os.path.join(args.data_dir, issue_jira_key+'.yaml')
+current_titles = get_titles([issue_mapping[k] for k in issues])
 
-    j = yaml.load(open(fname))
+# work out which titles need changing
+updates = {}
+for issue_jira_key in issues:
+    j = store.get(issue_jira_key)
+    title = j['title'] + ' (' + issue_jira_key + ')'
+    current_title = current_titles.get(issue_mapping[issue_jira_key])
+    if current_title is None:
+        logger.warning("%s (%s) not found on github",
+                       issue_jira_key, issue_mapping[issue_jira_key])
+        continue
+    if current_title != title:
+        updates[issue_jira_key] = title
+store.close()
 
-    issue_url = 'https://api.github.com/repos/' + issue_mapping[issue_jira_key]
+logger.info("%i of %i issues need updating", len(updates), len(issues))
 
-    updated_data = {
-        'title': j['title'] + ' (' + issue_jira_key + ')'
+# the session keeps the updates within github's rate limits
+failures = []
+with concurrent.futures.ThreadPoolExecutor(
+    max_workers=args.concurrency,
+) as executor:
+    futures = {
+        executor.submit(update_title, k, updates[k]): k
+        for k in sorted(updates, key=common.sort_jira_key)
     }
+    for f in concurrent.futures.as_completed(futures):
+        try:
+            f.result()
+        except Exception:
+            logger.exception("Error updating %s", futures[f])
+            failures.append(futures[f])
 
-    resp = github_session.patch(
-        issue_url,
-        json=updated_data,
-    )
-    resp.raise_for_status()
+github_session.log_stats()
+
+if failures:
+    raise Exception("Failed to update issues: %s" % ', '.join(
+        sorted(failures, key=common.sort_jira_key)
+    ))
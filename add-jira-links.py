@@ -4,13 +4,18 @@
 #
 # for each exported issue, add a link from the jira issue to the new github
 # issue
+#
+# the issues we have added links to are recorded in jira_links.log in the data
+# directory, so re-running only adds the links which are missing.
 
 import argparse
+import concurrent.futures
 import logging
 import os.path
 import yaml
 
 import common
+import mapping_db
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
@@ -24,33 +29,124 @@ parser.add_argument(
     '--data-dir', default='data',
     help='destination directory for exported issues. (default: %(default)s)'
 )
+parser.add_argument(
+    '--concurrency', type=int, default=10,
+    help='maximum number of concurrent requests to jira. '
+         '(default: %(default)s)'
+)
+parser.add_argument(
+    '--check-jira', action='store_true',
+    help='search jira for links which have already been added, rather than '
+         'relying on jira_links.log alone'
+)
 args = parser.parse_args()
 
 if args.debug:
     logging.getLogger().setLevel(logging.DEBUG)
 
 with open("config.yaml") as conf:
-    config = yaml.load(conf)
+    config = yaml.safe_load(conf)
 
-mapping_file = os.path.join(args.data_dir, 'issue_mapping.yaml')
-with open(mapping_file) as f:
-    issue_mapping = yaml.load(f)
+issue_mapping = mapping_db.open_mapping_db(args.data_dir)
 
-issues = args.issue
-if issues is None:
-    issues = sorted(issue_mapping.keys(), key=common.sort_jira_key)
+# the issues we have added links to, and the github issue we linked to. Uses
+# the same format as the issue mapping.
+linked = mapping_db.MappingDb(os.path.join(args.data_dir, 'jira_links.log'))
+
+jira_session = common.get_jira_session(config, pool_size=args.concurrency)
 
-jira_session = common.get_jira_session(config)
-for issue_jira_key in issues:
-    logger.info("Updating %s", issue_jira_key)
 
+def link_body(issue_jira_key):
     url = 'https://github.com/' + issue_mapping[issue_jira_key]
-    body = 'Migrated to github: %s' % url
+    return 'Migrated to github: %s' % url
+
+
+def find_existing_links(keys):
+    """search jira for the issues in `keys` which already have a link to
+    their github issue, and record them in `linked`"""
+    jql = 'key in ({keys}) AND comment ~ "\\"Migrated to github\\""'.format(
+        keys=', '.join(keys),
+    )
+    start_at = 0
+    while True:
+        resp = jira_session.get(
+            config['jira_url'] + '/rest/api/2/search',
+            params={
+                'jql': jql,
+                'fields': 'comment',
+                'startAt': start_at,
+                'maxResults': common.KEY_BATCH_SIZE,
+                # don't fail if an issue has since been deleted
+                'validateQuery': 'warn',
+            }
+        )
+        resp.raise_for_status()
+        r = resp.json()
+        for issue in r['issues']:
+            body = link_body(issue['key'])
+            comments = issue['fields']['comment']['comments']
+            if any(c['body'] == body for c in comments):
+                linked.add(issue['key'], issue_mapping[issue['key']])
+        start_at += len(r['issues'])
+        if not r['issues'] or start_at >= r['total']:
+            break
+
+
+def add_link(issue_jira_key):
+    logger.info("Updating %s", issue_jira_key)
 
     comment_url = config['jira_url'] + '/rest/api/2/issue/%s/comment' % (
         issue_jira_key
     )
-    resp = jira_session.post(comment_url, json={"body": body})
+    resp = jira_session.post(
+        comment_url, json={"body": link_body(issue_jira_key)},
+    )
     if resp.status_code >= 400:
         logger.error("Error from jira: %i: %s", resp.status_code, resp.json())
     resp.raise_for_status()
+    linked.add(issue_jira_key, issue_mapping[issue_jira_key])
+
+
+def todo(keys):
+    """the issues in `keys` which we haven't linked to their current github
+    issue"""
+    return [k for k in keys if linked.get(k) != issue_mapping[k]]
+
+
+issues = args.issue
+if issues is None:
+    issues = sorted(issue_mapping.keys(), key=common.sort_jira_key)
+
+executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=args.concurrency,
+)
+
+if args.check_jira:
+    keys = todo(issues)
+    logger.info("Checking jira for existing links on %i issues", len(keys))
+    batches = [
+        keys[i:i + common.KEY_BATCH_SIZE]
+        for i in range(0, len(keys), common.KEY_BATCH_SIZE)
+    ]
+    for _ in executor.map(find_existing_links, batches):
+        pass
+
+issues = todo(issues)
+logger.info("Adding links to %i issues", len(issues))
+
+failures = []
+futures = {executor.submit(add_link, k): k for k in issues}
+for f in concurrent.futures.as_completed(futures):
+    try:
+        f.result()
+    except Exception:
+        logger.exception("Error adding link to %s", futures[f])
+        failures.append(futures[f])
+
+executor.shutdown(wait=True)
+linked.close()
+
+if failures:
+    raise Exception("Failed to add links to issues: %s" % ', '.join(
+        sorted(failures, key=common.sort_jira_key)
+    ))
@@ -1,20 +1,30 @@
 #!/usr/bin/env python
 #
-# usage: add-oldissue-github-links.py
+# usage: add-oldissue-github-links.py <user>/<project>
 #
 # for each exported issue, add a link from the old github issue to the new one
+#
+# the issues we have added links to are recorded in oldissue_links.log in the
+# data directory, so re-running only adds the links which are missing.
 
 import argparse
+import concurrent.futures
 import logging
 import os.path
 
-import requests
 import yaml
 
+import common
+import mapping_db
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
 
 parser = argparse.ArgumentParser()
+parser.add_argument(
+    'proj', metavar='user/proj',
+    help='Github project the issues were exported from'
+)
 parser.add_argument('--debug', '-d', action='store_true')
 parser.add_argument(
     '--issue', action='append', help='Single issue to update'
@@ -23,40 +33,74 @@ parser.add_argument(
     '--data-dir', default='data',
     help='destination directory for exported issues. (default: %(default)s)'
 )
+parser.add_argument(
+    '--concurrency', type=int, default=4,
+    help='maximum number of comments to post at once. (default: %(default)s)'
+)
 args = parser.parse_args()
 
 if args.debug:
     logging.getLogger().setLevel(logging.DEBUG)
 
 with open("config.yaml") as conf:
-    config = yaml.load(conf)
+    config = yaml.safe_load(conf)
 
-mapping_file = os.path.join(args.data_dir, 'issue_mapping.yaml')
-with open(mapping_file) as f:
-    issue_mapping = yaml.load(f)
+issue_mapping = mapping_db.open_mapping_db(args.data_dir)
+
+# the old issues we have added links to, and the github issue we linked to.
+# Uses the same format as the issue mapping.
+linked = mapping_db.MappingDb(
+    os.path.join(args.data_dir, 'oldissue_links.log'),
+)
 
 issues = args.issue
 if issues is None:
     issues = sorted(issue_mapping.keys())
 
-github_session = requests.Session()
-github_session.headers.update({
-    'User-Agent': 'Jira issue import',
-    'Accept': 'application/vnd.github.v3+json',
-    'Authorization': 'token ' + config['github_token'],
-})
+github_session = common.get_github_session(
+    config, accept='application/vnd.github.v3+json',
+    pool_size=max(10, args.concurrency),
+)
+
 
-for old_issue_key in issues:
+def add_link(old_issue_key):
     logger.info("Updating %s", old_issue_key)
     url = 'https://github.com/' + issue_mapping[old_issue_key]
 
     comment_url = 'https://api.github.com/repos/%s/issues/%s/comments' % (
-        "matrix-org/matrix-doc",  # FIXME
+        args.proj,
         old_issue_key,
     )
 
     body = 'Migrated to: %s' % url
 
-    print("POST %s: %s" % (comment_url, body))
+    logger.debug("POST %s: %s", comment_url, body)
     resp = github_session.post(comment_url, json={"body": body})
     resp.raise_for_status()
+    linked.add(old_issue_key, issue_mapping[old_issue_key])
+
+
+# skip the issues we have already linked to their current github issue
+issues = [k for k in issues if linked.get(k) != issue_mapping[k]]
+logger.info("Adding links to %i issues", len(issues))
+
+# the session keeps the comments within github's rate limits
+failures = []
+with concurrent.futures.ThreadPoolExecutor(
+    max_workers=args.concurrency,
+) as executor:
+    futures = {executor.submit(add_link, k): k for k in issues}
+    for f in concurrent.futures.as_completed(futures):
+        try:
+            f.result()
+        except Exception:
+            logger.exception("Error adding link to %s", futures[f])
+            failures.append(futures[f])
+
+linked.close()
+github_session.log_stats()
+
+if failures:
+    raise Exception("Failed to add links to issues: %s" % ', '.join(
+        sorted(failures)
+    ))
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+#
+# usage: benchmark-issue-store.py
+#
+# compares the time taken to load exported issues from the original layout
+# (one yaml file per issue) with the packed store, with and without
+# compression.
+#
+# by default the issues are synthetic; use --data-dir to benchmark with a copy
+# of some real exported issues.
+
+import argparse
+import logging
+import os
+import random
+import shutil
+import tempfile
+import time
+import yaml
+
+import issue_store
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--debug', '-d', action='store_true')
+parser.add_argument(
+    '--issues', type=int, default=5000,
+    help='number of synthetic issues. (default: %(default)s)'
+)
+parser.add_argument(
+    '--data-dir',
+    help='use the issues exported to this directory instead of synthetic ones'
+)
+parser.add_argument(
+    '--seed', type=int, default=0,
+    help='seed for the issue generator. (default: %(default)s)'
+)
+args = parser.parse_args()
+
+if args.debug:
+    logging.getLogger().setLevel(logging.DEBUG)
+
+random.seed(args.seed)
+
+WORDS = [
+    'the', 'server', 'client', 'room', 'event', 'sync', 'PROJ-123', 'fails',
+    'when', 'http://example.com/some-path', '*bold*', '{{code}}',
+]
+
+
+def words(n):
+    return ' '.join(random.choice(WORDS) for _ in range(n))
+
+
+def gen_issue():
+    created = '2017-%02i-%02iT12:00:00Z' % (
+        random.randint(1, 12), random.randint(1, 28),
+    )
+    return {
+        'title': words(8),
+        'body': '\n'.join(words(15) for _ in range(random.randint(1, 20))),
+        'created_at': created,
+        'priority': random.choice(['Major', 'Minor', 'Critical']),
+        'type': random.choice(['Bug', 'Improvement']),
+        'status': random.choice(['Open', 'Pending Triage']),
+        'comments': [
+            {'body': words(40), 'created_at': created}
+            for _ in range(random.randint(0, 10))
+        ],
+        'attachments': [],
+        'remotelinks': {},
+        'links': [
+            {'direction': 'outward', 'other': 'PROJ-%i' % random.randint(1, 9),
+             'type': 'duplicates'}
+        ] if random.random() < 0.2 else [],
+        'watchers': ['@user%i' % i for i in range(random.randint(0, 3))],
+        'labels': [],
+    }
+
+
+def timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def dir_size(path):
+    return sum(
+        os.path.getsize(os.path.join(path, f)) for f in os.listdir(path)
+    )
+
+
+def load_all(store):
+    for key in store.keys():
+        store.get(key)
+
+
+def load_all_pure_yaml(store):
+    # how import-github-issues.py used to do it
+    for key in store.keys():
+        with open(store._path(key)) as f:
+            yaml.load(f, Loader=yaml.Loader)
+
+
+tmp = tempfile.mkdtemp()
+try:
+    if args.data_dir:
+        source = issue_store.open_issue_store(args.data_dir)
+        issues = {k: source.get(k) for k in source.keys()}
+        source.close()
+    else:
+        issues = {'PROJ-%i' % i: gen_issue() for i in range(args.issues)}
+    logger.info("%i issues", len(issues))
+
+    stores = []
+    for (name, fmt, compress) in (
+        ('yaml', 'yaml', False),
+        ('packed', 'packed', False),
+        ('packed+zlib', 'packed', True),
+    ):
+        d = os.path.join(tmp, name)
+        os.mkdir(d)
+        store = issue_store.open_issue_store(d, fmt, compress=compress)
+
+        def write_all():
+            for (k, v) in issues.items():
+                store.put(k, v)
+            store.close()
+
+        t = timed(write_all)
+        logger.info("%-16s write %7.3fs, %6.1f MB on disk",
+                    name, t, dir_size(d) / 1000000.0)
+        stores.append((name, d, fmt))
+
+    keys = list(issues.keys())
+    sample = [random.choice(keys) for _ in range(1000)]
+
+    for (name, d, fmt) in stores:
+        if fmt == 'yaml':
+            store = issue_store.open_issue_store(d, fmt)
+            t = timed(lambda: load_all_pure_yaml(store))
+            logger.info("%-16s load all %7.3fs", 'yaml (pure)', t)
+
+        # include the time to open the store, which for a packed store means
+        # reading the index.
+        store = None
+
+        def open_and_load():
+            global store
+            store = issue_store.open_issue_store(d, fmt)
+            load_all(store)
+
+        t = timed(open_and_load)
+        label = name + (' (C)' if fmt == 'yaml' and
+                        issue_store.YamlLoader is not yaml.Loader else '')
+        logger.info("%-16s load all %7.3fs", label, t)
+
+        def random_access():
+            for k in sample:
+                store.get(k)
+
+        t = timed(random_access)
+        logger.info("%-16s 1000 random gets %7.3fs", label, t)
+        store.close()
+finally:
+    shutil.rmtree(tmp)
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+#
+# usage: benchmark-jira-to-markdown.py
+#
+# measures the speed of jira_to_markdown.to_markdown on a synthetic corpus of
+# jira markup, and checks that it doesn't blow up on pathological input.
+#
+# exits non-zero if the conversion is superlinear on any of the pathological
+# inputs, or if the throughput has dropped too far below that recorded by a
+# previous run with --save-baseline.
+
+import argparse
+import logging
+import os.path
+import random
+import re
+import sys
+import time
+import yaml
+
+import jira_to_markdown
+from jira_to_markdown import to_markdown
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--debug', '-d', action='store_true')
+parser.add_argument(
+    '--size', type=float, default=1,
+    help='size of each part of the corpus, in MB. (default: %(default)s)'
+)
+parser.add_argument(
+    '--seed', type=int, default=0,
+    help='seed for the corpus generator. (default: %(default)s)'
+)
+parser.add_argument(
+    '--repeat', type=int, default=3,
+    help='number of times to time each conversion; the best time is used. '
+         '(default: %(default)s)'
+)
+parser.add_argument(
+    '--baseline', default='benchmark_baseline.yaml',
+    help='file of throughputs to compare against. (default: %(default)s)'
+)
+parser.add_argument(
+    '--save-baseline', action='store_true',
+    help='record the throughputs from this run in the baseline file'
+)
+parser.add_argument(
+    '--tolerance', type=float, default=0.2,
+    help='fraction by which throughput may fall below the baseline before '
+         'we fail. (default: %(default)s)'
+)
+args = parser.parse_args()
+
+if args.debug:
+    logging.getLogger().setLevel(logging.DEBUG)
+
+random.seed(args.seed)
+
+WORDS = [
+    'the', 'server', 'client', 'room', 'event', 'sync', 'PROJ-123', 'a_b',
+    'http://example.com/some-path', 'user@example.com', 'x', 'fails', 'when',
+]
+
+INLINE_MARKUP = [
+    ('*', '*'), ('{{', '}}'), ('??', '??'), ('+', '+'), ('^', '^'),
+    ('~', '~'), ('-', '-'),
+]
+
+
+def words(n):
+    return ' '.join(random.choice(WORDS) for _ in range(n))
+
+
+def markup(depth=0, used=()):
+    """A run of well-nested inline markup"""
+    leader, trailer = random.choice(
+        [m for m in INLINE_MARKUP if m not in used]
+    )
+    body = words(random.randint(1, 4))
+    if depth < 2 and random.random() < 0.3:
+        body += ' ' + markup(depth + 1, used + ((leader, trailer),))
+    return leader + body + trailer
+
+
+def prose_line():
+    parts = []
+    for _ in range(random.randint(3, 12)):
+        r = random.random()
+        if r < 0.6:
+            parts.append(words(1))
+        elif r < 0.9:
+            parts.append(markup())
+        else:
+            parts.append('[%s|http://example.com/%s]' % (words(2), words(1)))
+    line = ' '.join(parts)
+    if random.random() < 0.05:
+        line = 'h%i. %s' % (random.randint(1, 6), line)
+    return line
+
+
+def gen_prose():
+    return '\n'.join(prose_line() for _ in range(random.randint(1, 10)))
+
+
+def gen_code():
+    lines = [
+        '    ' * random.randint(0, 3) + words(random.randint(1, 10))
+        for _ in range(random.randint(20, 200))
+    ]
+    return '\n'.join(
+        [random.choice(['{code}', '{code:java}', '{noformat}'])]
+        + lines
+        + ['{code}']
+    )
+
+
+def gen_quote():
+    body = '\n\n'.join(gen_prose() for _ in range(random.randint(1, 4)))
+    return '{quote}\n%s\n{quote}\n%s' % (body, gen_prose())
+
+
+def gen_dense():
+    return ' '.join(
+        random.choice(['*%s*', '-%s-']) % words(random.randint(1, 2))
+        for _ in range(random.randint(50, 200))
+    )
+
+
+def gen_unbalanced():
+    leaders = ['*', '-', '{{', '??', '+', '^', '~', '[']
+    return ' '.join(
+        random.choice(leaders) + words(1)
+        for _ in range(random.randint(50, 200))
+    )
+
+
+CORPORA = [
+    ('prose', gen_prose),
+    ('code', gen_code),
+    ('quote', gen_quote),
+    ('dense', gen_dense),
+    ('unbalanced', gen_unbalanced),
+]
+
+# single lines which used to send the regexes into quadratic backtracking
+PATHOLOGICAL = [
+    ('unclosed bold', '*a '),
+    ('unclosed strikethrough', '-a b '),
+    ('unclosed monospace', '{{x '),
+    ('unclosed link', '[a|b '),
+    ('unclosed code', '{code '),
+    ('unclosed quote', '{quote}\n'),
+]
+
+
+def gen_corpus(gen, size):
+    docs = []
+    length = 0
+    while length < size:
+        doc = gen()
+        docs.append(doc)
+        length += len(doc) + 1
+    return docs
+
+
+def best_time(fn):
+    times = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def convert_all(docs):
+    for doc in docs:
+        to_markdown(doc)
+
+
+failures = []
+throughputs = {}
+size = int(args.size * 1000000)
+
+for name, gen in CORPORA:
+    docs = gen_corpus(gen, size)
+    mb = sum(len(d) for d in docs) / 1000000.0
+    t = best_time(lambda: convert_all(docs))
+    throughputs[name] = mb / t
+    logger.info("%-12s %6.2f MB in %6.3fs: %6.2f MB/s", name, mb, t, mb / t)
+
+# the cost of each rule's pattern, matched at each of its leaders across the
+# whole corpus.
+text = '\n'.join(
+    d for _, gen in CORPORA for d in gen_corpus(gen, size // len(CORPORA))
+)
+mb = len(text) / 1000000.0
+for rule in jira_to_markdown._rules:
+    leader = re.compile(rule.leader)
+
+    def match_rule():
+        for t in leader.finditer(text):
+            rule.regex.match(text, t.start())
+
+    t = best_time(match_rule)
+    logger.info("rule %-14s %6.3fs (%6.2f MB/s)", rule.name, t, mb / t)
+
+# check that quadrupling the size of the pathological inputs only roughly
+# quadruples the time taken to convert them.
+for name, chunk in PATHOLOGICAL:
+    small = chunk * 20000
+    large = chunk * 80000
+    t_small = best_time(lambda: to_markdown(small))
+    t_large = best_time(lambda: to_markdown(large))
+    ratio = t_large / t_small
+    logger.info("%-24s x4 input: x%.1f time (%.3fs)", name, ratio, t_large)
+    if ratio > 8:
+        failures.append("%s: superlinear conversion time (x%.1f for x4 input)"
+                        % (name, ratio))
+
+if os.path.exists(args.baseline):
+    with open(args.baseline) as f:
+        baseline = yaml.safe_load(f)
+    for name, mbps in sorted(baseline.items()):
+        if name not in throughputs:
+            continue
+        if throughputs[name] < mbps * (1 - args.tolerance):
+            failures.append("%s: throughput %.2f MB/s is below baseline %.2f"
+                            % (name, throughputs[name], mbps))
+
+if args.save_baseline:
+    with open(args.baseline, 'w') as f:
+        yaml.dump(throughputs, f, default_flow_style=False)
+
+for failure in failures:
+    logger.error(failure)
+if failures:
+    sys.exit(1)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+#
+# usage: benchmark-replace-jira-keys.py
+#
+# measures the speed of common.replace_jira_keys on comments full of jira keys,
+# as rewritten by update-github-links.py.
+#
+# exits non-zero if the time taken grows faster than linearly with the number
+# of keys in a comment.
+
+import argparse
+import logging
+import random
+import sys
+import time
+
+import common
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--debug', '-d', action='store_true')
+parser.add_argument(
+    '--keys', type=int, default=5000,
+    help='number of jira keys in the smallest comment. (default: %(default)s)'
+)
+parser.add_argument(
+    '--seed', type=int, default=0,
+    help='seed for the comment generator. (default: %(default)s)'
+)
+parser.add_argument(
+    '--repeat', type=int, default=3,
+    help='number of times to time each rewrite; the best time is used. '
+         '(default: %(default)s)'
+)
+args = parser.parse_args()
+
+if args.debug:
+    logging.getLogger().setLevel(logging.DEBUG)
+
+random.seed(args.seed)
+
+jira_key_regex = common.compile_jira_key_regex(['PROJ', 'OTHERPROJ'])
+
+
+def map_jira_key(key):
+    return '[%s](https://example.com/jira/browse/%s)' % (key, key)
+
+
+def gen_comment(n_keys):
+    """A comment mentioning n_keys keys, some of them already linkified"""
+    parts = []
+    for _ in range(n_keys):
+        key = '%s-%i' % (random.choice(['PROJ', 'OTHERPROJ']),
+                         random.randint(1, 20000))
+        r = random.random()
+        if r < 0.1:
+            parts.append('https://example.com/jira/browse/' + key)
+        elif r < 0.2:
+            parts.append('[%s]' % key)
+        else:
+            parts.append(key)
+        parts.append(random.choice(['see', 'and', 'duplicates', 'fixes']))
+    return ' '.join(parts)
+
+
+def best_time(fn):
+    times = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+times = {}
+for n_keys in (args.keys, args.keys * 4):
+    comment = gen_comment(n_keys)
+    t = best_time(
+        lambda: common.replace_jira_keys(comment, jira_key_regex, map_jira_key)
+    )
+    times[n_keys] = t
+    logger.info("%6i keys (%7i chars): %.4fs, %.2f MB/s",
+                n_keys, len(comment), t, len(comment) / t / 1000000.0)
+
+ratio = times[args.keys * 4] / times[args.keys]
+logger.info("x4 keys: x%.1f time", ratio)
+if ratio > 8:
+    logger.error("replace_jira_keys is superlinear in the number of keys")
+    sys.exit(1)
@@ -1,9 +1,24 @@
+import collections
+import logging
+import random
 import re
 import threading
+import time
 
 import requests
 
-localdata = threading.local()
+import http_cache
+
+logger = logging.getLogger(__name__)
+
+GITHUB_GRAPHQL_URL = 'https://api.github.com/graphql'
+
+# the number of issues we ask jira for by key in each search
+KEY_BATCH_SIZE = 100
+
+_jira_session = None
+_jira_session_lock = threading.Lock()
+_http_cache = None
 
 
 def sort_jira_key(key):
@@ -13,11 +28,310 @@ def sort_jira_key(key):
     return re.sub('^([A-Z]+-)([0-9]+)$', repl, key)
 
 
-def get_jira_session(config):
-    jira_session = getattr(localdata, 'jira_session', None)
-    if jira_session is None:
-        jira_session = requests.Session()
-        if 'jira_password' in config:
-            jira_session.auth = (config['jira_user'], config['jira_password'])
-        localdata.jira_session = jira_session
-    return jira_session
+def compile_jira_key_regex(project_keys):
+    """compile a big regexp which matches any jira key in the given projects"""
+    return re.compile(
+        r'(?<![\w\[])(' +  # don't match after a word character or [
+        '|'.join((re.escape(x) for x in project_keys)) +
+        r')-\d+(?!\w)'
+    )
+
+
+def replace_jira_keys(text, jira_key_regex, map_jira_key):
+    """look for jira keys in text and replace them with map_jira_key(key)
+
+    returns (new: string, updated: boolean) where updated is True if a change
+    was made
+    """
+    result = []
+    idx = 0
+    for match in jira_key_regex.finditer(text):
+        s = match.start()
+
+        # don't replace if the previous text is 'browse/', because that means
+        # it's already linkified.
+        if text.endswith('browse/', 0, s):
+            continue
+
+        # looks like a real match. make a substitution
+        result.append(text[idx:s])
+        result.append(map_jira_key(match.group()))
+        idx = match.end()
+
+    if not result:
+        return (text, False)
+
+    result.append(text[idx:])
+    return (''.join(result), True)
+
+
+def get_http_cache(config):
+    """Get the persistent HTTP response cache, if one is configured."""
+    global _http_cache
+    if _http_cache is None and config.get('http_cache'):
+        _http_cache = http_cache.HttpCache(
+            config['http_cache'],
+            max_size=config.get('http_cache_max_mb', 500) * 1024 * 1024,
+        )
+    return _http_cache
+
+
+def _make_adapter(cache, pool_size):
+    if cache is not None:
+        return http_cache.CachingAdapter(
+            cache, pool_connections=1, pool_maxsize=pool_size,
+        )
+    return requests.adapters.HTTPAdapter(
+        pool_connections=1, pool_maxsize=pool_size,
+    )
+
+
+def get_jira_session(config, pool_size=10):
+    """Get the requests session for talking to jira.
+
+    The session is shared between all threads, so that every request goes
+    through a single pool of (up to pool_size) keep-alive connections.
+    """
+    global _jira_session
+    with _jira_session_lock:
+        if _jira_session is None:
+            jira_session = requests.Session()
+            adapter = _make_adapter(get_http_cache(config), pool_size)
+            jira_session.mount('http://', adapter)
+            jira_session.mount('https://', adapter)
+            if 'jira_password' in config:
+                jira_session.auth = (
+                    config['jira_user'], config['jira_password']
+                )
+            _jira_session = jira_session
+    return _jira_session
+
+
+class TokenBucket(object):
+    """Limits the rate at which things happen
+
+    Allows bursts of up to `capacity`, and `rate` per second on average.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self):
+        """Wait until a token is available, and take it.
+
+        Returns the number of seconds we waited.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._last) * self.rate
+            )
+            self._last = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0
+            # we're in debt: wait until it is paid off. Holding the lock means
+            # that everyone else waits behind us.
+            wait = -self._tokens / self.rate
+            time.sleep(wait)
+            return wait
+
+
+class GithubSession(requests.Session):
+    """A requests session for the github API
+
+    Keeps within github's rate limits: requests which make changes are limited
+    to writes_per_minute (to stay under the secondary rate limits), and once
+    the primary rate limit starts to run low we spread the remaining requests
+    out until it resets. Requests which are rate-limited anyway, or fail with
+    a server error, are retried with jittered exponential backoff.
+
+    Counts of requests, retries and time spent waiting are kept in `stats`.
+    """
+
+    # github's suggested wait after a secondary rate limit, if it doesn't tell
+    # us how long to wait.
+    SECONDARY_LIMIT_WAIT = 60
+
+    # methods which are safe to retry after a server error, as well as after
+    # being rate-limited.
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PATCH', 'PUT', 'DELETE')
+
+    def __init__(self, token, accept=None, pool_size=10, max_retries=5,
+                 writes_per_minute=75, low_water_fraction=0.1, cache=None):
+        super(GithubSession, self).__init__()
+        self.cache = cache
+        self.mount('https://', _make_adapter(cache, pool_size))
+        self.headers.update({
+            'User-Agent': 'Jira issue import',
+            'Authorization': 'token ' + token,
+        })
+        if accept is not None:
+            self.headers['Accept'] = accept
+
+        self.max_retries = max_retries
+        self.low_water_fraction = low_water_fraction
+        self.stats = collections.Counter()
+        self._stats_lock = threading.Lock()
+        self.rate_limit = None
+        self.rate_limit_remaining = None
+        self.rate_limit_reset = None
+
+        self._write_bucket = TokenBucket(writes_per_minute / 60.0, 10)
+        self._pacing_lock = threading.Lock()
+        self._next_request = 0
+
+    def request(self, method, url, *args, **kwargs):
+        method = method.upper()
+        # we only use graphql for queries, so they are neither writes nor
+        # unsafe to retry.
+        is_query = method in ('GET', 'HEAD', 'OPTIONS') or (
+            url == GITHUB_GRAPHQL_URL
+        )
+        idempotent = is_query or method in self.IDEMPOTENT_METHODS
+        attempt = 0
+        while True:
+            self._throttle(is_query)
+            try:
+                resp = super(GithubSession, self).request(
+                    method, url, *args, **kwargs
+                )
+            except requests.ConnectionError as e:
+                if not idempotent or attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+                logger.warning("Error from %s %s: %s; retrying in %.1fs",
+                               method, url, e, delay)
+            else:
+                self.count_stat('requests')
+                self._update_rate_limit(resp)
+                delay = self._retry_delay(idempotent, resp, attempt)
+                if delay is None:
+                    return resp
+                logger.warning("%i from %s %s; retrying in %.1fs",
+                               resp.status_code, method, url, delay)
+
+            self.count_stat('retries')
+            self.count_stat('seconds_waited', delay)
+            time.sleep(delay)
+            attempt += 1
+
+    def paginate(self, url, params=None):
+        """GET a github listing, following the pagination links"""
+        for (items, next_url) in self.paginate_pages(url, params or {}):
+            for item in items:
+                yield item
+
+    def paginate_pages(self, url, params=None):
+        """GET a github listing a page at a time
+
+        Yields (items, next_url) for each page; next_url is None for the last
+        page. To carry on from a page, pass its next_url as url, with no
+        params.
+        """
+        if params is not None:
+            params = dict(params, per_page=100)
+        while url is not None:
+            resp = self.get(url, params=params)
+            resp.raise_for_status()
+            url = resp.links.get("next", {}).get("url")
+            params = None
+            yield (resp.json(), url)
+
+    def graphql(self, query, **variables):
+        """run a graphql query, and return its data"""
+        resp = self.post(
+            GITHUB_GRAPHQL_URL,
+            json={'query': query, 'variables': variables},
+        )
+        resp.raise_for_status()
+        r = resp.json()
+        if r.get('errors'):
+            raise Exception("Error from github graphql: %r" % r['errors'])
+        return r['data']
+
+    def count_stat(self, name, n=1):
+        with self._stats_lock:
+            self.stats[name] += n
+
+    def log_stats(self):
+        if self.cache is not None:
+            self.cache.log_stats()
+        logger.info(
+            "github: %i requests, %i retries, %.1fs spent waiting; "
+            "%s requests remaining",
+            self.stats['requests'], self.stats['retries'],
+            self.stats['seconds_waited'], self.rate_limit_remaining,
+        )
+
+    def _throttle(self, is_query):
+        if not is_query:
+            self.count_stat('seconds_waited', self._write_bucket.take())
+
+        with self._pacing_lock:
+            now = time.time()
+            wait = self._next_request - now
+            if wait > 0:
+                self.count_stat('seconds_waited', wait)
+                time.sleep(wait)
+                now += wait
+            self._next_request = now + self._pacing_interval(now)
+
+    def _pacing_interval(self, now):
+        """How long to leave before the next request, to make the primary
+        rate limit last until it resets"""
+        remaining = self.rate_limit_remaining
+        if remaining is None:
+            return 0
+        if remaining > self.rate_limit * self.low_water_fraction:
+            return 0
+        return max(0, self.rate_limit_reset - now) / max(remaining, 1)
+
+    def _update_rate_limit(self, resp):
+        h = resp.headers
+        if 'X-RateLimit-Remaining' in h:
+            self.rate_limit = int(h.get('X-RateLimit-Limit', 5000))
+            self.rate_limit_remaining = int(h['X-RateLimit-Remaining'])
+            self.rate_limit_reset = int(h['X-RateLimit-Reset'])
+
+    def _retry_delay(self, idempotent, resp, attempt):
+        """Work out whether to retry a request, and how long to wait first
+
+        Returns None if the response should be returned as it is.
+        """
+        if attempt >= self.max_retries:
+            return None
+
+        if resp.status_code in (403, 429):
+            if 'Retry-After' in resp.headers:
+                self.count_stat('rate_limited')
+                return int(resp.headers['Retry-After'])
+            if resp.headers.get('X-RateLimit-Remaining') == '0':
+                self.count_stat('rate_limited')
+                return max(1, self.rate_limit_reset - time.time() + 1)
+            if 'rate limit' in resp.text:
+                self.count_stat('rate_limited')
+                return self._backoff(attempt, self.SECONDARY_LIMIT_WAIT)
+            return None
+
+        if resp.status_code >= 500 and idempotent:
+            return self._backoff(attempt)
+
+        return None
+
+    def _backoff(self, attempt, base=1):
+        return min(base * 2 ** attempt, 600) * random.uniform(0.5, 1.5)
+
+
+def get_github_session(config, accept=None, pool_size=10):
+    """Get a rate-limited requests session for talking to github."""
+    return GithubSession(
+        config['github_token'],
+        accept=accept,
+        pool_size=pool_size,
+        writes_per_minute=config.get('github_writes_per_minute', 75),
+        cache=get_http_cache(config),
+    )
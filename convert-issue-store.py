@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+#
+# usage: convert-issue-store.py --to packed
+#
+# converts the exported issues in the data directory between the yaml and
+# packed formats (see issue_store.py). The old copies are left in place, but
+# the other scripts will use the packed store if there is one.
+#
+# If there is already a packed store, --to packed compacts it instead,
+# dropping the records of issues which have since been re-exported.
+
+import argparse
+import logging
+import os.path
+import sys
+
+import issue_store
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--debug', '-d', action='store_true')
+parser.add_argument(
+    '--data-dir', default='data',
+    help='directory containing the exported issues. (default: %(default)s)'
+)
+parser.add_argument(
+    '--to', choices=issue_store.FORMATS, required=True,
+    help='format to convert to'
+)
+parser.add_argument(
+    '--compress', action='store_true',
+    help='compress the issues in the packed store'
+)
+args = parser.parse_args()
+
+if args.debug:
+    logging.getLogger().setLevel(logging.DEBUG)
+
+pack_file = os.path.join(args.data_dir, issue_store.PACK_FILE)
+
+if args.to == 'packed' and os.path.exists(pack_file):
+    # the yaml files are out of date once we've exported into the pack, so
+    # don't convert them again.
+    store = issue_store.PackedStore(args.data_dir)
+    reclaimed = store.compact()
+    n_issues = len(store.keys())
+    store.close()
+    logger.info("Compacted %i issues in %s; reclaimed %i bytes",
+                n_issues, pack_file, reclaimed)
+    sys.exit(0)
+
+if args.to == 'packed':
+    source = issue_store.YamlDirStore(args.data_dir)
+    dest = issue_store.PackedStore(args.data_dir, compress=args.compress)
+else:
+    if not os.path.exists(pack_file):
+        logger.error("No packed store in %s", args.data_dir)
+        sys.exit(1)
+    source = issue_store.PackedStore(args.data_dir)
+    dest = issue_store.YamlDirStore(args.data_dir)
+
+keys = source.keys()
+written = 0
+for key in keys:
+    if dest.put(key, source.get(key)):
+        written += 1
+dest.close()
+source.close()
+
+logger.info("Converted %i issues; %i were already up to date",
+            len(keys), len(keys) - written)
+
+if args.to == 'yaml':
+    # otherwise the other scripts would go on using the packed store
+    os.rename(pack_file, pack_file + '.old')
+    logger.info("Renamed %s to %s.old", pack_file, pack_file)
+    index_file = os.path.join(args.data_dir, issue_store.INDEX_FILE)
+    if os.path.exists(index_file):
+        os.remove(index_file)
@@ -1,11 +1,35 @@
 #!/usr/bin/env python
 #
 # dump the contents of the db used by import-github-issues.py
+#
+# safe to run while an import is in progress.
+
+import argparse
+
+import common
+import status_db
 
-import shelve
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    '--data-dir', default='data',
+    help='directory containing the status db. (default: %(default)s)'
+)
+parser.add_argument(
+    '--status', help='only dump the issues with this status (eg pending)'
+)
+parser.add_argument(
+    '--summary', action='store_true',
+    help='just print the number of issues in each state'
+)
+args = parser.parse_args()
 
-statusfile = 'data/status.db'
-status = shelve.open(statusfile)
+status = status_db.open_status_db(args.data_dir)
 
-for k, v in status.items():
-    print("%s: %r" % (k, v))
+if args.summary:
+    for (k, v) in sorted(status.counts().items()):
+        print("%s: %i" % (k, v))
+else:
+    items = status.items(args.status)
+    items.sort(key=lambda i: common.sort_jira_key(i[0]))
+    for (k, v) in items:
+        print("%s: %r" % (k, v))
@@ -3,14 +3,25 @@
 # usage: export-github-isssues.py <user>/<project> <labels>
 #
 # create a yaml file for each github ticket, with info about it
+#
+# by default the issues are listed with the REST api, which takes a request
+# per issue to get the comments. With --graphql, the issues are fetched along
+# with their comments, 100 at a time.
+#
+# the position in the listing is saved in the data directory after each page,
+# so an interrupted export carries on where it left off when re-run.
 
 import argparse
+import concurrent.futures
+import functools
 import logging
 import os.path
 
-import requests
 import yaml
 
+import common
+import issue_store
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
 
@@ -27,20 +38,105 @@ parser.add_argument(
     '--data-dir', default='data',
     help='destination directory for exported issues. (default: %(default)s)'
 )
+parser.add_argument(
+    '--store-format', choices=issue_store.FORMATS,
+    help='how to store the exported issues: one yaml file per issue, or '
+         'packed into a single file. (default: whichever is already in the '
+         'data directory, or yaml)'
+)
+parser.add_argument(
+    '--compress', action='store_true',
+    help='compress the issues in a packed store'
+)
+parser.add_argument(
+    '--graphql', action='store_true',
+    help='use the graphql api, which needs far fewer requests'
+)
+parser.add_argument(
+    '--concurrency', type=int, default=10,
+    help='maximum number of issues to fetch the comments for at once. '
+         '(default: %(default)s)'
+)
+parser.add_argument(
+    '--incremental', action='store_true',
+    help='only export issues which have been updated since the last export, '
+         'or which failed to export last time'
+)
+parser.add_argument(
+    '--retries', type=int, default=2,
+    help='number of times to retry exporting issues which fail. '
+         '(default: %(default)s)'
+)
 args = parser.parse_args()
 
 if args.debug:
     logging.getLogger().setLevel(logging.DEBUG)
 
 with open("config.yaml") as conf:
-    config = yaml.load(conf)
+    config = yaml.safe_load(conf)
+
+
+# the fields we need from each issue, and the first page of its comments
+ISSUE_FIELDS = """
+fragment issueFields on Issue {
+  id
+  number
+  state
+  title
+  createdAt
+  url
+  author { login }
+  labels(first: 100) { nodes { name } }
+  comments(first: 100) {
+    pageInfo { hasNextPage endCursor }
+    nodes { body createdAt author { login } }
+  }
+}
+"""
+
+ISSUES_QUERY = """
+query($owner: String!, $name: String!, $labels: [String!],
+      $states: [IssueState!], $since: DateTime, $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    issues(first: 100, after: $cursor, labels: $labels, states: $states,
+           filterBy: {since: $since},
+           orderBy: {field: CREATED_AT, direction: ASC}) {
+      pageInfo { hasNextPage endCursor }
+      nodes { ...issueFields }
+    }
+  }
+}
+""" + ISSUE_FIELDS
+
+COMMENTS_QUERY = """
+query($id: ID!, $cursor: String) {
+  node(id: $id) {
+    ... on Issue {
+      comments(first: 100, after: $cursor) {
+        pageInfo { hasNextPage endCursor }
+        nodes { body createdAt author { login } }
+      }
+    }
+  }
+}
+"""
+
+
+def get_comments(issue):
+    """get the comments on an issue from the REST api"""
+    return list(github_session.paginate(issue["comments_url"]))
 
 
-def export_issue(issue):
+def export_issue(issue, get_comments=get_comments):
+    """build the data for an issue, and write it to the store
+
+    issue is in the form returned by the REST api; get_comments(issue)
+    returns its comments, likewise.
+    """
     issue_url = issue['url']
     logger.info("Processing %s", issue_url)
 
-    comments = list(paginated_request(issue["comments_url"]))
+    comments = get_comments(issue)
     if len(comments) > 0:
         first_comment = comments[0]["body"]
         comments = comments[1:]
@@ -81,37 +177,306 @@ def export_issue(issue):
             )
         })
 
-    output_file = os.path.join(args.data_dir, str(issue['number']) + '.yaml')
-    with open(output_file, 'w') as f:
-        yaml.dump(data, f, default_flow_style=False)
+    store.put(str(issue['number']), data)
+
+
+def get_issue_pages(proj, labels, since, cursor):
+    """yield (issues, cursor) for each page of issues in a project
+
+    The issues are (issue, get_comments) pairs, to pass to export_issue.
+    cursor is where the next page starts, or None after the last one.
+
+    The issues are listed oldest first, so that issues being created while we
+    are running don't move the later pages.
+    """
+    if cursor is not None:
+        pages = github_session.paginate_pages(cursor)
+    else:
+        params = {
+            'labels': labels, 'sort': 'created', 'direction': 'asc',
+        }
+        if since is not None:
+            # we need to see closed issues too, so that we can spot the ones
+            # which have been closed since the last export.
+            params.update(since=since, state='all')
+        pages = github_session.paginate_pages(
+            'https://api.github.com/repos/%s/issues' % (proj), params,
+        )
+
+    for (items, cursor) in pages:
+        # the issues api returns pull requests too
+        issues = [
+            (issue, get_comments) for issue in items
+            if 'pull_request' not in issue
+        ]
+        yield (issues, cursor)
+
+
+def map_graphql_comment(comment):
+    """turn a comment node from a graphql query into the REST form"""
+    return {
+        'created_at': comment['createdAt'],
+        'body': comment['body'],
+        # the author is null if their account has been deleted
+        'user': {'login': (comment['author'] or {'login': 'ghost'})['login']},
+    }
+
+
+def get_graphql_comments(node, issue):
+    """get all the comments on an issue node, in the REST form
+
+    The first page comes with the issue; if there are any more, we ask for
+    them by the issue's node id.
+    """
+    connection = node['comments']
+    comments = [map_graphql_comment(c) for c in connection['nodes']]
+    while connection['pageInfo']['hasNextPage']:
+        r = github_session.graphql(
+            COMMENTS_QUERY, id=node['id'],
+            cursor=connection['pageInfo']['endCursor'],
+        )
+        connection = r['node']['comments']
+        comments.extend(map_graphql_comment(c) for c in connection['nodes'])
+    return comments
+
+
+def get_issue_pages_graphql(proj, labels, since, cursor):
+    """yield (issues, cursor) for each page of issues in a project, like
+    get_issue_pages, but with the graphql api
+
+    Pull requests are a separate type in graphql, so they don't show up here.
+    """
+    (owner, name) = proj.split('/')
+    labels = [l for l in labels.split(',') if l]
+    while True:
+        r = github_session.graphql(
+            ISSUES_QUERY, owner=owner, name=name, labels=labels or None,
+            states=['OPEN', 'CLOSED'] if since is not None else ['OPEN'],
+            since=since, cursor=cursor,
+        )
+        issues = []
+        connection = r['repository']['issues']
+        for node in connection['nodes']:
+            issue_labels = [l['name'] for l in node['labels']['nodes']]
+
+            # graphql returns issues with any of the labels, whereas the REST
+            # api (and so the non-graphql export) wants all of them.
+            if not set(labels).issubset(issue_labels):
+                continue
 
+            issue = {
+                'url': node['url'],
+                'html_url': node['url'],
+                'number': node['number'],
+                'state': node['state'].lower(),
+                'title': node['title'],
+                'created_at': node['createdAt'],
+                'user': {
+                    'login': (node['author'] or {'login': 'ghost'})['login'],
+                },
+                'labels': [{'name': l} for l in issue_labels],
+            }
+            issues.append((
+                issue, functools.partial(get_graphql_comments, node),
+            ))
 
-def get_issues(proj, params):
-    return paginated_request(
+        if not connection['pageInfo']['hasNextPage']:
+            yield (issues, None)
+            break
+        cursor = connection['pageInfo']['endCursor']
+        yield (issues, cursor)
+
+
+def get_high_water_mark(proj):
+    """Get the time of the most recent update to any issue in the project
+
+    Returns None if there are no issues.
+    """
+    resp = github_session.get(
         'https://api.github.com/repos/%s/issues' % (proj),
-        params=params,
+        params={
+            'state': 'all', 'sort': 'updated', 'direction': 'desc',
+            'per_page': 1,
+        },
     )
+    resp.raise_for_status()
+    issues = resp.json()
+    if not issues:
+        return None
+    return issues[0]['updated_at']
+
 
+def issue_jobs(issues):
+    """turn a page of (issue, get_comments) pairs into jobs for export_issues
 
-def paginated_request(url, method="get", **kwargs):
-    resp = github_session.request(method, url, **kwargs)
+    Closed issues are noted in closed_issues, rather than being exported.
+    """
+    jobs = []
+    for (issue, get_comments) in issues:
+        if issue['state'] == 'closed':
+            if issue['number'] not in closed_issues:
+                logger.info("%s has been closed", issue['html_url'])
+                closed_issues.add(issue['number'])
+            continue
+        closed_issues.discard(issue['number'])
+        jobs.append((
+            issue['number'],
+            functools.partial(export_issue, issue, get_comments),
+        ))
+    return jobs
+
+
+def export_single_issue(number):
+    """export an issue by its number, if it is still one we want"""
+    resp = github_session.get(
+        'https://api.github.com/repos/%s/issues/%i' % (args.proj, number),
+    )
     resp.raise_for_status()
-    for item in resp.json():
-        yield item
-    while "next" in resp.links:
-        logger.info("Requesting %s", url)
-        resp = github_session.get(resp.links["next"]["url"])
-        resp.raise_for_status()
-        for item in resp.json():
-            yield item
-
-
-github_session = requests.Session()
-github_session.headers.update({
-    'User-Agent': 'Jira issue import',
-    'Accept': 'application/vnd.github.v3+json',
-    'Authorization': 'token ' + config['github_token'],
-})
-
-for issue in get_issues(args.proj, { "labels": args.labels }):
-    export_issue(issue)
+    issue = resp.json()
+    labels = set(label['name'] for label in issue['labels'])
+    if 'pull_request' in issue or not labels.issuperset(
+        l for l in args.labels.split(',') if l
+    ):
+        return
+    for (number, job) in issue_jobs([(issue, get_comments)]):
+        job()
+
+
+def export_issues(pages):
+    """run the jobs in each page from `pages` in parallel
+
+    pages yields (jobs, cursor), where jobs is a list of (issue number, job)
+    pairs. After each page, cursor is saved in the export state, so that we
+    can carry on from there if we are interrupted.
+
+    Returns a map from issue number to exception for the issues which failed.
+    """
+    failures = {}
+    for (jobs, cursor) in pages:
+        futures = {executor.submit(job): number for (number, job) in jobs}
+        for f in concurrent.futures.as_completed(futures):
+            try:
+                f.result()
+            except Exception as e:
+                logger.exception("Error exporting issue %i", futures[f])
+                failures[futures[f]] = e
+
+        export_state['failed'] = sorted(
+            set(export_state['failed']).union(failures)
+        )
+        export_state['resume']['cursor'] = cursor
+        write_state()
+    return failures
+
+
+def retry_issues(numbers):
+    return export_issues([(
+        [(n, functools.partial(export_single_issue, n)) for n in numbers],
+        None,
+    )])
+
+
+def write_state():
+    export_state['closed'] = sorted(closed_issues)
+    with open(state_file, 'w') as f:
+        yaml.dump(export_state, f, default_flow_style=False)
+
+
+github_session = common.get_github_session(
+    config, accept='application/vnd.github.v3+json',
+    pool_size=max(10, args.concurrency),
+)
+executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=args.concurrency,
+)
+
+store = issue_store.open_issue_store(
+    args.data_dir, args.store_format, compress=args.compress,
+)
+
+# export_state: {
+#   last_updated: time of the most recent update seen by the last export,
+#   closed: [numbers of exported issues which have since been closed]
+#   failed: [numbers of issues which we failed to export last time]
+#   resume: {   # the export in progress, if any
+#     proj, labels, graphql, since: the options it was run with
+#     last_updated: the high-water mark when it started
+#     cursor: where to carry on from in the issue listing
+#   }
+# }
+state_file = os.path.join(
+    args.data_dir, issue_store.GITHUB_EXPORT_STATE_FILE,
+)
+export_state = issue_store.load_export_state(
+    args.data_dir, issue_store.GITHUB_EXPORT_STATE_FILE,
+)
+export_state.setdefault('failed', [])
+
+since = None
+if args.incremental:
+    since = export_state.get('last_updated')
+
+# the cursor is only any use for the same listing of the same repository.
+resume = export_state.get('resume')
+if resume and resume['cursor'] is not None and (
+    resume.get('proj') == args.proj and resume['labels'] == args.labels
+    and resume['graphql'] == args.graphql and resume['since'] == since
+):
+    logger.info("Carrying on from where the last export stopped")
+else:
+    # take the high-water mark before we start, so that anything updated
+    # while we are running gets picked up next time.
+    resume = {
+        'proj': args.proj,
+        'labels': args.labels,
+        'graphql': args.graphql,
+        'since': since,
+        'last_updated': get_high_water_mark(args.proj),
+        'cursor': None,
+    }
+    if since:
+        logger.info("Exporting issues updated since %s", since)
+    else:
+        # a full export tries the issues which failed last time anyway
+        export_state['failed'] = []
+    export_state['resume'] = resume
+
+closed_issues = set(export_state.get('closed', []))
+
+# the issues which failed last time need exporting whether or not they have
+# been updated since.
+previous_failures = export_state['failed']
+
+get_pages = get_issue_pages_graphql if args.graphql else get_issue_pages
+failures = export_issues(
+    (issue_jobs(issues), cursor) for (issues, cursor) in get_pages(
+        args.proj, args.labels, resume['since'], resume['cursor'],
+    )
+)
+
+if previous_failures:
+    logger.info("Exporting %i issues which failed last time",
+                len(previous_failures))
+    failures.update(retry_issues(previous_failures))
+
+for attempt in range(args.retries):
+    if not failures:
+        break
+    logger.info("Retrying %i failed issues", len(failures))
+    failures = retry_issues(sorted(failures))
+
+executor.shutdown(wait=True)
+store.close()
+github_session.log_stats()
+
+# record the failures, so that an incremental export can try them again
+failed_issues = sorted(failures)
+export_state['last_updated'] = resume['last_updated']
+export_state['failed'] = failed_issues
+del export_state['resume']
+write_state()
+
+if failed_issues:
+    raise Exception("Failed to export issues: %s" % ', '.join(
+        str(n) for n in failed_issues
+    ))
@@ -5,14 +5,14 @@
 # create a yaml file for each jira ticket, with info about it
 
 import argparse
-import datetime
 import logging
-import multiprocessing
 import os.path
 import yaml
 
 import common
-from jira_to_markdown import to_markdown
+import issue_store
+import jira_export
+import pipeline
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
@@ -25,162 +25,142 @@ parser.add_argument(
     '--data-dir', default='data',
     help='destination directory for exported issues. (default: %(default)s)'
 )
+parser.add_argument(
+    '--concurrency', type=int, default=10,
+    help='maximum number of concurrent requests to jira. '
+         '(default: %(default)s)'
+)
+parser.add_argument(
+    '--search-concurrency', type=int, default=4,
+    help='maximum number of search result pages to fetch at once. '
+         '(default: %(default)s)'
+)
+parser.add_argument(
+    '--incremental', action='store_true',
+    help='only export issues which have been updated since the last export, '
+         'or which failed to export last time'
+)
+parser.add_argument(
+    '--retries', type=int, default=2,
+    help='number of times to retry exporting issues which fail. '
+         '(default: %(default)s)'
+)
+parser.add_argument(
+    '--store-format', choices=issue_store.FORMATS,
+    help='how to store the exported issues: one yaml file per issue, or '
+         'packed into a single file. (default: whichever is already in the '
+         'data directory, or yaml)'
+)
+parser.add_argument(
+    '--compress', action='store_true',
+    help='compress the issues in a packed store'
+)
 args = parser.parse_args()
 
 if args.debug:
     logging.getLogger().setLevel(logging.DEBUG)
 
 with open("config.yaml") as conf:
-    config = yaml.load(conf)
+    config = yaml.safe_load(conf)
 
+exporter = jira_export.JiraExporter(
+    config, args.proj, search_concurrency=args.search_concurrency,
+)
+store = issue_store.open_issue_store(
+    args.data_dir, args.store_format, compress=args.compress,
+)
 
-def map_user(user, fallback_to_display_name=True):
-    """Map a jira user object to a github @user
-
-    Takes a jira user object with 'name' and 'displayname' properties
+# make sure the jira session has enough connections for all our threads
+common.get_jira_session(
+    config, pool_size=args.concurrency + args.search_concurrency,
+)
 
-    Returns @githubuser, or just display name if fallback_to_display_name is
-    True, else None.
-    """
-    jira_id = user['name']
-    if jira_id in config['user_map']:
-        return "@" + config['user_map'][jira_id]
 
-    if fallback_to_display_name:
-        return user['displayName']
+def write_issue(item):
+    """the last pipeline stage: write the issue to the store"""
+    (issue_key, data) = item
+    if not store.put(issue_key, data):
+        logger.debug("%s is unchanged", issue_key)
+        exporter.count_stat('unchanged_issues')
 
-    return None
 
+def export_issues(jql):
+    """export the issues matched by jql
 
-def map_time(time):
-    """ Map from jira's time format to iso format (which github accepts).
+    The issues are streamed through a pipeline of bounded queues, so we only
+    hold a few pages of search results at a time.
 
-    Basically this just drops the millisecond component.
+    Returns a map from jira key to exception for the issues which failed.
     """
-    d = datetime.datetime.strptime(time, '%Y-%m-%dT%H:%M:%S.000%z')
-    return d.isoformat()
-
-
-def export_issue(issue):
-    issue_key = issue['key']
-    logger.info("Processing %s", issue_key)
-
-    fields = issue['fields']
-
-    # build the body of the github issue
-    body = "{body}\n\n(Imported from {url})".format(
-        body=to_markdown(fields['description']),
-        url=config['jira_url'] + "/browse/"+issue['key']
-    )
-    creator = fields['reporter']
-    if creator['name'] != 'neb':
-        body += '\n\n(Reported by %s)' % map_user(creator)
-
-    # build comments for the github issue
-    comments = []
-    for comment in fields['comment']['comments']:
-        comments.append({
-            'created_at': map_time(comment['created']),
-            'body': "{body}\n\n-- {user}".format(
-                body=to_markdown(comment['body']),
-                user=map_user(comment['author'])
-            )
-        })
-
-    # process attachments
-    attachments = []
-    for a in fields['attachment']:
-        # 'content' is actually the url.
-        attachments.append(a['content'])
-
-    # process issue links
-    links = []
-    for l in fields['issuelinks']:
-        if 'inwardIssue' in l:
-            direction = 'inward'
-            other = l['inwardIssue']
-        elif 'outwardIssue' in l:
-            direction = 'outward'
-            other = l['outwardIssue']
-        else:
-            raise Exception('link neither inward nor outward: %r' % l)
-        links.append({
-            'direction': direction,
-            'other': other['key'],
-            'type': l['type'][direction]
-        })
-
-    # get external links
-    resp = common.get_jira_session(config).get(
-        config['jira_url'] + '/rest/api/2/issue/' + issue_key + '/remotelink'
-    )
-    resp.raise_for_status()
-    r = resp.json()
-    remotelinks = {}
-    for l in r:
-        o = l['object']
-        remotelinks[o['title']] = o['url']
-
-    # get watchers
-    resp = common.get_jira_session(config).get(fields['watches']['self'])
-    resp.raise_for_status()
-    r = resp.json()
-    watchers = []
-    for w in r['watchers']:
-        u = map_user(w, fallback_to_display_name=False)
-        if u is not None:
-            watchers.append(u)
-
-    data = {
-        'title': fields['summary'],
-        'body': body,
-        'created_at': map_time(fields['created']),
-        'priority': fields['priority']['name'],
-        'type': fields['issuetype']['name'],
-        'status': fields['status']['name'],
-        'comments': comments,
-        'attachments': attachments,
-        'remotelinks': remotelinks,
-        'links': links,
-        'watchers': watchers,
-        'labels': fields['labels'],
-    }
-
-    output_file = os.path.join(args.data_dir, issue_key + '.yaml')
-    with open(output_file, 'w') as f:
-        yaml.dump(data, f, default_flow_style=False)
-
-
-threadpool = multiprocessing.Pool(processes=10)
-
-jql = """
+    p = pipeline.Pipeline(queue_size=args.concurrency * 2)
+    exporter.add_stages(p, args.concurrency)
+    p.add_stage('write', write_issue)
+    p.start()
+    exporter.feed(p, jql)
+    p.close()
+    return p.failures
+
+
+# export_state: {
+#   last_updated: time of the most recent update seen by the last export,
+#   resolved: [jira keys of exported issues which have since been resolved]
+#   failed: [jira keys of issues which we failed to export last time]
+# }
+state_file = os.path.join(args.data_dir, issue_store.EXPORT_STATE_FILE)
+export_state = issue_store.load_export_state(args.data_dir)
+
+# take the high-water mark before we start, so that anything updated while we
+# are running gets picked up next time.
+high_water_mark = exporter.get_high_water_mark()
+
+if args.incremental and export_state.get('last_updated'):
+    # we need to see resolved issues too, so that we can spot the ones which
+    # have been resolved since the last export.
+    logger.info("Exporting issues updated since %s",
+                export_state['last_updated'])
+    updated = 'updated >= "{mark}"'.format(mark=export_state['last_updated'])
+
+    # the issues which failed last time need exporting whether or not they
+    # have been updated since.
+    if export_state.get('failed'):
+        updated = '({updated} OR key in ({keys}))'.format(
+            updated=updated, keys=', '.join(export_state['failed']),
+        )
+    jql = """
+project = {proj} AND {updated} ORDER BY id ASC
+""".format(proj=args.proj, updated=updated)
+else:
+    jql = """
 project = {proj} AND resolution IS EMPTY ORDER BY id ASC
 """.format(proj=args.proj)
 
-issue_index = 0
-total = None
-asyncresults = []
+exporter.resolved_issues = set(export_state.get('resolved', []))
 
-while total is None or issue_index < total:
-    result = common.get_jira_session(config).get(
-        config['jira_url'] + '/rest/api/2/search',
-        params={
-            'jql': jql,
-            'fields': '*all',
-            'startAt': issue_index,
-        }
-    )
-    result.raise_for_status()
-    r = result.json()
+failures = export_issues(jql)
 
-    asyncresults.append(threadpool.map_async(export_issue, r['issues']))
+for attempt in range(args.retries):
+    if not failures:
+        break
+    logger.info("Retrying %i failed issues", len(failures))
+    retry_failures = {}
+    for q in exporter.jql_for_keys(failures):
+        retry_failures.update(export_issues(q))
+    failures = retry_failures
 
-    issue_index += len(r['issues'])
-    total = r['total']
+store.close()
+exporter.close()
 
-threadpool.close()
+exporter.log_stats()
 
-for r in asyncresults:
-    r.get()
+# record the failures, so that an incremental export can try them again
+failed_issues = sorted(failures, key=common.sort_jira_key)
+export_state['last_updated'] = high_water_mark
+export_state['resolved'] = sorted(
+    exporter.resolved_issues, key=common.sort_jira_key,
+)
+export_state['failed'] = failed_issues
+with open(state_file, 'w') as f:
+    yaml.dump(export_state, f, default_flow_style=False)
 
-threadpool.join()
+if failed_issues:
+    raise Exception("Failed to export issues: %s" % ', '.join(failed_issues))
@@ -0,0 +1,214 @@
+import logging
+import time
+
+import common
+
+logger = logging.getLogger(__name__)
+
+# limits on how often we check on the progress of each import, in seconds
+MIN_POLL_INTERVAL = 1
+MAX_POLL_INTERVAL = 60
+
+
+class GithubImporter(object):
+    """Imports issues to a github project, with the github import API
+
+    (https://gist.github.com/jonmagic/5282384165e0f86ef105)
+
+    github_session should be a common.GithubSession which accepts the
+    golden-comet preview media type.
+    """
+    def __init__(self, config, github_session, proj, old_issue_number=True):
+        self.config = config
+        self.github_session = github_session
+        self.proj = proj
+        self.old_issue_number = old_issue_number
+
+    def build_import(self, issueKey, j):
+        """build the request to import an exported issue"""
+        body = j['body']
+
+        # just dump attachment links in the body
+        if j['attachments']:
+            body += '\n\n#### Attachments:\n'
+            for a in j['attachments']:
+                body += '%s\n' % a
+
+        comments = j['comments']
+
+        # special comment which we will edit to contain the links
+        if j['links'] or j['remotelinks']:
+            comments.insert(0, {
+                'body': "JIRA LINK PLACEHOLDER",
+                'created_at': j['created_at'],
+            })
+
+        # special comment to subscribe the watchers
+        if j['watchers']:
+            comments.insert(0, {
+                'body': "Jira watchers: " + ' '.join(j['watchers']),
+                'created_at': j['created_at'],
+            })
+
+        labels = j['labels']
+
+        if j['status'] != 'Pending Triage':
+            priority_map = self.config['priority_to_label_map']
+            priority_label = priority_map.get(j['priority'])
+            if priority_label is not None:
+                labels.append(priority_label)
+
+            type_label = self.config['type_to_label_map'].get(j['type'])
+            if type_label is not None:
+                labels.append(type_label)
+
+        title = j['title']
+
+        if self.old_issue_number:
+            title += ' (' + issueKey + ')'
+
+        return {
+            'issue': {
+                'title': title,
+                'body': body,
+                'created_at': j['created_at'],
+                'labels': labels,
+            }, 'comments': comments,
+        }
+
+    def submit_import(self, issueKey, data):
+        """start the import of an issue; returns the import status"""
+        logger.debug("Importing: %s", data)
+
+        resp = self.github_session.post(
+            'https://api.github.com/repos/%s/import/issues' % (self.proj),
+            json=data
+        )
+        if resp.status_code >= 400:
+            logger.error(
+                "Error from github for %s: %i: %s",
+                issueKey, resp.status_code, resp.text,
+            )
+        resp.raise_for_status()
+        return resp.json()
+
+    def wait_for_imports(self, status, statuses, issue_mapping):
+        """wait for imports to finish
+
+        statuses is a list of (jira key, import status) pairs, as stored in
+        status (a status_db.StatusDb), which is updated as each import
+        finishes. The new issues are added to issue_mapping (a
+        mapping_db.MappingDb).
+        """
+        # the working set of imports we are still waiting for
+        pending = {}
+        for (issue_jira_key, issueStatus) in statuses:
+            stat = issueStatus['status']
+            if stat == 'imported':
+                self._record_imported(issue_mapping, issue_jira_key,
+                                      issueStatus)
+            elif stat == 'pending':
+                pending[issue_jira_key] = issueStatus
+            else:
+                raise Exception("Unknown status " + stat)
+
+        # when to next check each pending issue individually, and how long to
+        # wait after that.
+        next_poll = {k: 0 for k in pending}
+        poll_interval = {k: MIN_POLL_INTERVAL for k in pending}
+
+        # how long to wait between checking the list of imports
+        sweep_interval = MIN_POLL_INTERVAL
+
+        while pending:
+            logger.info('Waiting for %i imports', len(pending))
+            listed = self._list_import_statuses(pending)
+            progress = False
+
+            now = time.time()
+            for issue_jira_key in sorted(pending, key=common.sort_jira_key):
+                issueStatus = pending[issue_jira_key]
+
+                listed_status = None
+                if listed is not None:
+                    listed_status = listed.get(issueStatus['url'])
+                if listed_status == 'pending':
+                    # no need to check this one individually
+                    continue
+                if listed_status is None and next_poll[issue_jira_key] > now:
+                    continue
+
+                # we need the individual status to find out the new issue's
+                # url
+                resp = self.github_session.get(issueStatus['url'])
+                resp.raise_for_status()
+                issueStatus.update(resp.json())
+                stat = issueStatus['status']
+
+                if stat == 'pending':
+                    interval = poll_interval[issue_jira_key]
+                    next_poll[issue_jira_key] = now + interval
+                    poll_interval[issue_jira_key] = min(
+                        interval * 2, MAX_POLL_INTERVAL
+                    )
+                    continue
+
+                status[issue_jira_key] = issueStatus
+                del pending[issue_jira_key]
+                progress = True
+                if stat == 'imported':
+                    self._record_imported(issue_mapping, issue_jira_key,
+                                          issueStatus)
+                else:
+                    status.flush()
+                    raise Exception("Unknown status %s for %s" % (
+                        stat, issue_jira_key
+                    ))
+
+            status.flush()
+            if not pending:
+                break
+
+            if progress:
+                sweep_interval = MIN_POLL_INTERVAL
+            else:
+                sweep_interval = min(sweep_interval * 2, MAX_POLL_INTERVAL)
+
+            if listed is not None:
+                time.sleep(sweep_interval)
+            else:
+                # wait for the next individual check
+                time.sleep(max(
+                    MIN_POLL_INTERVAL,
+                    min(next_poll[k] for k in pending) - time.time(),
+                ))
+
+    def _record_imported(self, issue_mapping, issue_jira_key, issueStatus):
+        url = issueStatus['issue_url']
+        p = url.replace('https://api.github.com/repos/', '')
+        link = 'https://github.com/' + p
+        logger.info('%s imported: %s', issue_jira_key, link)
+        issue_mapping.add(issue_jira_key, p)
+
+    def _list_import_statuses(self, pending):
+        """Ask github for the status of all recent imports, in one request
+
+        Returns a map from import status url to status, or None if github
+        wouldn't tell us.
+        """
+        params = {}
+        created = [
+            s['created_at'] for s in pending.values() if 'created_at' in s
+        ]
+        if len(created) == len(pending):
+            params['since'] = min(created)
+
+        resp = self.github_session.get(
+            'https://api.github.com/repos/%s/import/issues' % (self.proj),
+            params=params,
+        )
+        if resp.status_code >= 400:
+            logger.warning("Unable to list import statuses: %i",
+                           resp.status_code)
+            return None
+        return {s['url']: s['status'] for s in resp.json()}
@@ -0,0 +1,234 @@
+import collections
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# headers which describe the transfer rather than the resource, or which go
+# stale (the rate limit headers), and so aren't kept in the cache.
+_UNCACHED_HEADERS = (
+    'content-encoding', 'content-length', 'transfer-encoding', 'connection',
+    'keep-alive', 'date', 'set-cookie', 'x-ratelimit-limit',
+    'x-ratelimit-remaining', 'x-ratelimit-reset', 'x-ratelimit-used',
+    'x-ratelimit-resource',
+)
+
+
+class HttpCache(object):
+    """A persistent cache of HTTP responses
+
+    Responses are stored in a sqlite database, along with their ETag and
+    Last-Modified headers so that they can be revalidated with conditional
+    requests. Once the total size of the cached bodies exceeds max_size, the
+    least recently used responses are evicted.
+
+    Counts of cache hits and misses are kept in `stats`.
+    """
+    def __init__(self, path, max_size=500 * 1024 * 1024):
+        self.max_size = max_size
+        self.stats = collections.Counter()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                url TEXT,
+                etag TEXT,
+                last_modified TEXT,
+                headers TEXT,
+                body BLOB,
+                size INTEGER,
+                last_used REAL
+            )
+        """)
+        self._db.execute("""
+            CREATE INDEX IF NOT EXISTS responses_last_used
+            ON responses (last_used)
+        """)
+        self._db.commit()
+        self._size = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+
+    def get(self, key):
+        """Look up a cached response
+
+        Returns a dict with etag, last_modified, headers and body, or None.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT etag, last_modified, headers, body"
+                " FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._db.execute(
+                "UPDATE responses SET last_used = ? WHERE key = ?",
+                (time.time(), key),
+            )
+            self._db.commit()
+        return {
+            'etag': row[0],
+            'last_modified': row[1],
+            'headers': json.loads(row[2]),
+            'body': bytes(row[3]),
+        }
+
+    def put(self, key, url, etag, last_modified, headers, body):
+        with self._lock:
+            old = self._db.execute(
+                "SELECT size FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if old is not None:
+                self._size -= old[0]
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses"
+                " (key, url, etag, last_modified, headers, body, size,"
+                "  last_used)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, url, etag, last_modified, json.dumps(dict(headers)),
+                 body, len(body), time.time()),
+            )
+            self._size += len(body)
+            self._evict()
+            self._db.commit()
+
+    def refresh(self, key, etag, last_modified, headers):
+        """update the headers of a cached response which has been
+        revalidated, leaving the body alone"""
+        with self._lock:
+            self._db.execute(
+                "UPDATE responses SET etag = ?, last_modified = ?,"
+                " headers = ?, last_used = ? WHERE key = ?",
+                (etag, last_modified, json.dumps(dict(headers)), time.time(),
+                 key),
+            )
+            self._db.commit()
+
+    def _evict(self):
+        while self._size > self.max_size:
+            rows = self._db.execute(
+                "SELECT key, size FROM responses ORDER BY last_used LIMIT 100"
+            ).fetchall()
+            if not rows:
+                break
+            for (key, size) in rows:
+                if self._size <= self.max_size:
+                    break
+                self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._size -= size
+                self.stats['evicted'] += 1
+
+    def count_stat(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def log_stats(self):
+        logger.info(
+            "http cache: %i revalidated, %i misses, %i evicted",
+            self.stats['revalidated'], self.stats['misses'],
+            self.stats['evicted'],
+        )
+
+
+class CachingAdapter(requests.adapters.HTTPAdapter):
+    """A transport adapter which serves GET requests from an HttpCache
+
+    Cached responses are always revalidated with If-None-Match or
+    If-Modified-Since, rather than trusting their max-age, since we change
+    things on the server ourselves. A 304 from github doesn't count against
+    the rate limit.
+    """
+    def __init__(self, cache, **kwargs):
+        super(CachingAdapter, self).__init__(**kwargs)
+        self.cache = cache
+
+    def send(self, request, **kwargs):
+        if request.method != 'GET':
+            return super(CachingAdapter, self).send(request, **kwargs)
+
+        key = _cache_key(request)
+        entry = self.cache.get(key)
+        if entry is not None:
+            if entry['etag']:
+                request.headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                request.headers['If-Modified-Since'] = entry['last_modified']
+
+        resp = super(CachingAdapter, self).send(request, **kwargs)
+
+        if resp.status_code == 304 and entry is not None:
+            self.cache.count_stat('revalidated')
+            # read the (empty) body, so that the connection goes back to the
+            # pool.
+            resp.content
+            resp.close()
+            headers = requests.structures.CaseInsensitiveDict(
+                entry['headers']
+            )
+            headers.update(_cacheable_headers(resp.headers))
+            self.cache.refresh(
+                key, headers.get('ETag'), headers.get('Last-Modified'),
+                headers,
+            )
+            # pass on the fresh rate limit headers from the 304.
+            headers.update(
+                (k, v) for (k, v) in resp.headers.items()
+                if k.lower().startswith('x-ratelimit-')
+            )
+            return self._cached_response(request, headers, entry['body'])
+
+        self.cache.count_stat('misses')
+        if resp.status_code == 200:
+            self._store(key, request, _cacheable_headers(resp.headers),
+                        resp.content)
+        return resp
+
+    def _store(self, key, request, headers, body):
+        if 'no-store' in headers.get('Cache-Control', ''):
+            return
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        if not (etag or last_modified):
+            return
+        self.cache.put(key, request.url, etag, last_modified, headers, body)
+
+    def _cached_response(self, request, headers, body):
+        resp = requests.models.Response()
+        resp.status_code = 200
+        resp.reason = 'OK'
+        resp.headers = requests.structures.CaseInsensitiveDict(headers)
+        resp.encoding = requests.utils.get_encoding_from_headers(resp.headers)
+        resp._content = body
+        resp.url = request.url
+        resp.request = request
+        resp.connection = self
+        resp.from_cache = True
+        return resp
+
+
+def _cache_key(request):
+    """The key for a request: the URL, and anything which could change the
+    response we get for it."""
+    h = hashlib.sha256()
+    for part in (
+        request.url,
+        request.headers.get('Authorization', ''),
+        request.headers.get('Accept', ''),
+    ):
+        h.update(part.encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def _cacheable_headers(headers):
+    return requests.structures.CaseInsensitiveDict(
+        (k, v) for (k, v) in headers.items()
+        if k.lower() not in _UNCACHED_HEADERS
+    )
@@ -11,15 +11,18 @@
 # everyone who gets mentioned.
 
 import argparse
+import collections
+import concurrent.futures
+import itertools
 import logging
 import os.path
-import re
-import shelve
 import yaml
 
-import requests
-
 import common
+import github_import
+import issue_store
+import mapping_db
+import status_db
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
@@ -46,170 +49,180 @@ parser.add_argument(
     help="Disable the inclusion of the old issue number in the new issue's "
          "title",
 )
+parser.add_argument(
+    '--concurrency', type=int, default=4,
+    help='maximum number of import requests to send at once. '
+         '(default: %(default)s)'
+)
+parser.add_argument(
+    '--prefetch', type=int, default=4,
+    help='number of threads loading the exported issues ahead of the import '
+         'requests. (default: %(default)s)'
+)
+parser.add_argument(
+    '--ordered', action='store_true',
+    help='send the import requests one at a time, so that the github issue '
+         'numbers are in the same order as the jira keys'
+)
 args = parser.parse_args()
 
 if args.debug:
     logging.getLogger().setLevel(logging.DEBUG)
 
 with open('config.yaml') as conf:
-    config = yaml.load(conf)
-
-github_session = requests.Session()
-github_session.headers.update({
-    'User-Agent': 'Jira issue import',
-    'Accept': 'application/vnd.github.golden-comet-preview+json',
-    'Authorization': 'token ' + config['github_token'],
-})
-
-# status: {
-#   PROJ-N: {
-#     status: pending | imported | failed,
-#     url: gh import status url,
-#     issue_url: github issue url (via the API)
-#   }
-# }
-statusfile = os.path.join(args.data_dir, 'status.db')
-status = shelve.open(statusfile)
+    config = yaml.safe_load(conf)
+
+github_session = common.get_github_session(
+    config, accept='application/vnd.github.golden-comet-preview+json',
+    pool_size=max(10, args.concurrency),
+)
+
+importer = github_import.GithubImporter(
+    config, github_session, args.proj,
+    old_issue_number=not args.no_old_issue_number,
+)
+
+# map from jira key to import status: see status_db.StatusDb
+status = status_db.open_status_db(args.data_dir)
+logger.info("Import statuses: %s", status.counts())
+
+store = issue_store.open_issue_store(args.data_dir)
 
 issues = args.issue
 if issues is None:
-    issues = [
-        fname.replace('.yaml', '')
-        for fname in os.listdir(args.data_dir)
-        if re.match('.*[0-9]+\.yaml', fname)
-    ]
-
+    # skip the issues which the exporter has seen resolved (or closed)
+    # since they were exported
+    closed = issue_store.closed_keys(args.data_dir)
+    exported = store.keys()
+    issues = [k for k in exported if k not in closed]
     issues.sort(key=common.sort_jira_key)
+    if len(issues) < len(exported):
+        logger.info("Skipping %i issues which have been closed",
+                    len(exported) - len(issues))
 
 #
 # STEP 1: kick off import processes for any issues which haven't yet been
 # imported.
 #
-count = 0
+
+
+def build_import(issueKey):
+    """load an exported issue, and build the request to import it"""
+    logger.info('Processing %s', issueKey)
+    return importer.build_import(issueKey, store.get(issueKey))
+
+
+# issues which are already done / in progress
+started = set(status.keys('imported')) | set(status.keys('pending'))
+
+to_import = []
 for issueKey in issues:
-    if args.limit is not None and count >= args.limit:
+    if args.limit is not None and len(to_import) >= args.limit:
         break
+    if issueKey not in started:
+        to_import.append(issueKey)
 
-    fname = os.path.join(args.data_dir, issueKey+'.yaml')
+# in ordered mode, we only have one import request in flight at a time, so
+# that github numbers the new issues in the same order as the jira keys.
+post_concurrency = 1 if args.ordered else args.concurrency
 
+prefetch_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=args.prefetch,
+)
+post_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=post_concurrency,
+)
+
+# the payloads being built, in the order we want to submit them. We only
+# build a few ahead of the POSTs, to keep the memory use down.
+to_build = iter(to_import)
+building = collections.deque(
+    (k, prefetch_executor.submit(build_import, k))
+    for k in itertools.islice(to_build, args.prefetch * 2)
+)
+posting = {}
+failed_imports = []
+
+
+def import_done(future):
+    """record the result of an import request in the status db
+
+    The write isn't committed until the next status.flush().
+    """
+    issueKey = posting.pop(future)
+    try:
+        result = future.result()
+    except Exception:
+        logger.exception("Failed to import %s", issueKey)
+        failed_imports.append(issueKey)
+        return
     issueStatus = status.get(issueKey, {})
-    stat = issueStatus.setdefault('status', '')
-
-    if stat == 'imported' or stat == 'pending':
-        # already done / in progress
-        continue
-
-    logger.info('Processing %s (%s)', fname, issueKey)
-
-    j = yaml.load(open(fname))
-
-    body = j['body']
-
-    # just dump attachment links in the body
-    if j['attachments']:
-        body += '\n\n#### Attachments:\n'
-        for a in j['attachments']:
-            body += '%s\n' % a
-
-    comments = j['comments']
-
-    # special comment which we will edit to contain the links
-    if j['links'] or j['remotelinks']:
-        comments.insert(0, {
-            'body': "JIRA LINK PLACEHOLDER",
-            'created_at': j['created_at'],
-        })
-
-    # special comment to subscribe the watchers
-    if j['watchers']:
-        comments.insert(0, {
-            'body': "Jira watchers: " + ' '.join(j['watchers']),
-            'created_at': j['created_at'],
-        })
-
-    labels = j['labels']
-
-    if j['status'] != 'Pending Triage':
-        priority_label = config['priority_to_label_map'].get(j['priority'])
-        if priority_label is not None:
-            labels.append(priority_label)
-
-        type_label = config['type_to_label_map'].get(j['type'])
-        if type_label is not None:
-            labels.append(type_label)
-
-    title = j['title']
-
-    if not args.no_old_issue_number:
-        title += ' (' + issueKey + ')'
-
-    data = {
-        'issue': {
-            'title': title,
-            'body': body,
-            'created_at': j['created_at'],
-            'labels': labels,
-        }, 'comments': comments,
-    }
-
-    logger.debug("Importing: %s", data)
-
-    resp = github_session.post(
-        'https://api.github.com/repos/%s/import/issues' % (args.proj),
-        json=data
-    )
-    if resp.status_code >= 400:
-        logger.error(
-            "Error from github: %i: %s", resp.status_code, resp.json()
-        )
-    resp.raise_for_status()
-    issueStatus.update(resp.json())
+    issueStatus.update(result)
     status[issueKey] = issueStatus
 
-    count += 1
 
-issues = args.issue
-if issues is None:
-    issues = status.keys()
-has_pending = True
-issue_mapping = {}
+while building and not failed_imports:
+    (issueKey, build_future) = building.popleft()
+    try:
+        data = build_future.result()
+    except Exception:
+        logger.exception("Failed to load %s", issueKey)
+        failed_imports.append(issueKey)
+        break
+    k = next(to_build, None)
+    if k is not None:
+        building.append((k, prefetch_executor.submit(build_import, k)))
+
+    # wait for a slot in the POST pool
+    while len(posting) >= post_concurrency:
+        (done, _) = concurrent.futures.wait(
+            posting, return_when=concurrent.futures.FIRST_COMPLETED,
+        )
+        for f in done:
+            import_done(f)
+        status.flush()
 
-mapping_file = os.path.join(args.data_dir, 'issue_mapping.yaml')
-if os.path.exists(mapping_file):
-    with open(mapping_file) as f:
-        issue_mapping = yaml.load(f)
+    # don't start any more imports once one has failed
+    if failed_imports:
+        break
+
+    posting[
+        post_executor.submit(importer.submit_import, issueKey, data)
+    ] = issueKey
+
+# make sure that we record the status of every import which was started, even
+# if something went wrong, so that we don't start them again next time.
+for f in concurrent.futures.as_completed(list(posting)):
+    import_done(f)
+status.flush()
+
+prefetch_executor.shutdown(cancel_futures=True)
+store.close()
+post_executor.shutdown()
+
+if failed_imports:
+    raise Exception("Failed to import issues: %s" % ', '.join(
+        sorted(failed_imports, key=common.sort_jira_key)
+    ))
+
+if args.issue is None:
+    statuses = status.items()
+else:
+    statuses = [(k, status[k]) for k in args.issue]
+issue_mapping = mapping_db.open_mapping_db(args.data_dir, create=True)
 
 #
-# STEP 2: check the import progress for each issue in the database, and write a
-# mapping file
+# STEP 2: check the import progress for each issue in the database, and record
+# each new issue in the mapping as its import finishes
 #
-while has_pending:
-    has_pending = False
-    for issue_jira_key in issues:
-        logger.info('Checking %s', issue_jira_key)
-
-        issueStatus = status[issue_jira_key]
-        stat = issueStatus['status']
-
-        if stat == 'pending':
-            resp = github_session.get(issueStatus['url'])
-            resp.raise_for_status()
-            issueStatus.update(resp.json())
-            status[issue_jira_key] = issueStatus
-            logger.info('status now: %s', issueStatus['status'])
-
-        stat = issueStatus['status']
-        if stat == 'imported':
-            url = issueStatus['issue_url']
-            p = url.replace('https://api.github.com/repos/', '')
-            link = 'https://github.com/' + p
-            logger.info('imported: %s', link)
-            issue_mapping[issue_jira_key] = p
-
-        elif stat == 'pending':
-            has_pending = True
-        else:
-            raise Exception("Unknown status " + stat)
-
-with open(mapping_file, 'w') as f:
-    yaml.dump(issue_mapping, f, default_flow_style=False)
+importer.wait_for_imports(status, statuses, issue_mapping)
+
+# keep the yaml version of the mapping up to date, for anything else which
+# reads it.
+issue_mapping.export_yaml(
+    os.path.join(args.data_dir, mapping_db.YAML_FILE)
+)
+issue_mapping.close()
+
+status.close()
+github_session.log_stats()
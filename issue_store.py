@@ -0,0 +1,363 @@
+import json
+import logging
+import os
+import os.path
+import re
+import struct
+import threading
+import zlib
+
+import yaml
+
+logger = logging.getLogger(__name__)
+
+# use the C yaml parser if it's available: it is much faster.
+YamlLoader = getattr(yaml, 'CLoader', yaml.Loader)
+
+# written by export-jira-issues.py and export-github-issues.py respectively
+EXPORT_STATE_FILE = 'export_state.yaml'
+GITHUB_EXPORT_STATE_FILE = 'github_export_state.yaml'
+
+PACK_FILE = 'issues.pack'
+INDEX_FILE = 'issues.idx'
+
+FORMATS = ('yaml', 'packed')
+
+
+class YamlDirStore(object):
+    """Exported issues, stored as one yaml file per issue
+
+    This is the original layout of the data directory.
+    """
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+
+    def keys(self):
+        return [
+            fname[:-len('.yaml')]
+            for fname in os.listdir(self.data_dir)
+            if re.match(r'.*[0-9]+\.yaml$', fname)
+        ]
+
+    def get(self, key):
+        with open(self._path(key)) as f:
+            return yaml.load(f, Loader=YamlLoader)
+
+    def put(self, key, data):
+        """store an issue; returns False if it was already stored as-is
+
+        The file is only rewritten if it has changed, so that its mtime stays
+        put.
+        """
+        output = yaml.dump(data, default_flow_style=False)
+        path = self._path(key)
+        if os.path.exists(path):
+            with open(path) as f:
+                if f.read() == output:
+                    return False
+        with open(path, 'w') as f:
+            f.write(output)
+        return True
+
+    def close(self):
+        pass
+
+    def _path(self, key):
+        return os.path.join(self.data_dir, key + '.yaml')
+
+
+class PackedStore(object):
+    """Exported issues, packed into a single file
+
+    Each issue is stored as a record in issues.pack, made up of a header
+    giving the length of the key, some flags and the length of the data, then
+    the key and the issue data as JSON (optionally zlib-compressed). Replacing
+    an issue appends a new record.
+
+    issues.idx records the offset of the latest record for each key, and is
+    written by close(). If it is missing or out of date (because we crashed),
+    it is rebuilt by reading the record headers. compact() drops the records
+    which have been replaced.
+    """
+    _HEADER = struct.Struct('>HBI')
+    _COMPRESSED = 1
+
+    def __init__(self, data_dir, compress=False):
+        self.compress = compress
+        self._pack_path = os.path.join(data_dir, PACK_FILE)
+        self._index_path = os.path.join(data_dir, INDEX_FILE)
+        self._lock = threading.Lock()
+
+        # open without truncating, creating the file if need be
+        fd = os.open(self._pack_path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._file = os.fdopen(fd, 'r+b')
+        self._size = os.fstat(fd).st_size
+
+        # map from key to (offset, flags, length) of the issue data
+        self._index_dirty = False
+        self._index = self._load_index()
+        if self._index is None:
+            self._index = self._scan() if self._size else {}
+
+    def keys(self):
+        return list(self._index.keys())
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def get(self, key):
+        (offset, flags, length) = self._index[key]
+        return json.loads(self._read(offset, flags, length))
+
+    def put(self, key, data):
+        """store an issue; returns False if it was already stored as-is"""
+        raw = json.dumps(data, sort_keys=True).encode('utf-8')
+        with self._lock:
+            if key in self._index and self._read(*self._index[key]) == raw:
+                return False
+
+            flags = 0
+            if self.compress:
+                raw = zlib.compress(raw)
+                flags |= self._COMPRESSED
+            k = key.encode('utf-8')
+            header = self._HEADER.pack(len(k), flags, len(raw))
+
+            self._file.seek(self._size)
+            self._file.truncate()
+            self._file.write(header + k + raw)
+            self._file.flush()
+
+            offset = self._size + len(header) + len(k)
+            self._index[key] = (offset, flags, len(raw))
+            self._size = offset + len(raw)
+            self._index_dirty = True
+        return True
+
+    def compact(self):
+        """rewrite the pack file with only the latest record for each key
+
+        Returns the number of bytes reclaimed.
+        """
+        with self._lock:
+            tmp = self._pack_path + '.tmp'
+            index = {}
+            size = 0
+            with open(tmp, 'wb') as f:
+                for (key, (offset, flags, length)) in sorted(
+                        self._index.items(), key=lambda i: i[1][0]):
+                    raw = os.pread(self._file.fileno(), length, offset)
+                    k = key.encode('utf-8')
+                    f.write(self._HEADER.pack(len(k), flags, length) + k)
+                    f.write(raw)
+                    size += self._HEADER.size + len(k)
+                    index[key] = (size, flags, length)
+                    size += length
+                f.flush()
+                os.fsync(f.fileno())
+
+            # if we crash before writing the new index, the next open will
+            # rebuild it rather than using the one for the old file.
+            if os.path.exists(self._index_path):
+                os.remove(self._index_path)
+            os.replace(tmp, self._pack_path)
+
+            reclaimed = self._size - size
+            self._file.close()
+            self._file = open(self._pack_path, 'r+b')
+            self._size = size
+            self._index = index
+            self._write_index()
+        return reclaimed
+
+    def close(self):
+        with self._lock:
+            if self._index_dirty:
+                self._write_index()
+            self._file.close()
+
+    def _read(self, offset, flags, length):
+        raw = os.pread(self._file.fileno(), length, offset)
+        if flags & self._COMPRESSED:
+            raw = zlib.decompress(raw)
+        return raw
+
+    def _load_index(self):
+        """read the index file, if it matches the pack file"""
+        if not os.path.exists(self._index_path):
+            return None
+        with open(self._index_path) as f:
+            idx = json.load(f)
+        if idx['pack_size'] != self._size:
+            logger.info("%s is out of date", self._index_path)
+            return None
+        return {k: tuple(v) for (k, v) in idx['index'].items()}
+
+    def _write_index(self):
+        tmp = self._index_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'pack_size': self._size, 'index': self._index}, f)
+        os.replace(tmp, self._index_path)
+        self._index_dirty = False
+
+    def _scan(self):
+        """rebuild the index from the record headers in the pack file"""
+        logger.info("Indexing %s", self._pack_path)
+        index = {}
+        offset = 0
+        f = self._file
+        while True:
+            f.seek(offset)
+            header = f.read(self._HEADER.size)
+            if len(header) < self._HEADER.size:
+                break
+            (key_len, flags, length) = self._HEADER.unpack(header)
+            k = f.read(key_len)
+            data_offset = offset + self._HEADER.size + key_len
+            if len(k) < key_len or data_offset + length > self._size:
+                break
+            index[k.decode('utf-8')] = (data_offset, flags, length)
+            offset = data_offset + length
+
+        if offset < self._size:
+            # the last record is incomplete: it will be overwritten by the next
+            # put().
+            logger.warning("Ignoring incomplete record at end of %s",
+                           self._pack_path)
+            self._size = offset
+        self._index_dirty = True
+        return index
+
+
+def detect_format(data_dir):
+    if os.path.exists(os.path.join(data_dir, PACK_FILE)):
+        return 'packed'
+    return 'yaml'
+
+
+def open_issue_store(data_dir, fmt=None, compress=False):
+    """Open the store of exported issues in data_dir
+
+    fmt is one of FORMATS; if it is None, we use a packed store if there is
+    one in data_dir, and otherwise the yaml files. compress only affects
+    issues written to a packed store.
+    """
+    if fmt is None:
+        fmt = detect_format(data_dir)
+    if fmt == 'packed':
+        return PackedStore(data_dir, compress=compress)
+    if fmt == 'yaml':
+        return YamlDirStore(data_dir)
+    raise ValueError("Unknown issue store format %r" % (fmt,))
+
+
+def load_export_state(data_dir, name=EXPORT_STATE_FILE):
+    """load the state which an exporter keeps in data_dir, or {} if there
+    isn't any"""
+    path = os.path.join(data_dir, name)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return yaml.safe_load(f) or {}
+
+
+def closed_keys(data_dir):
+    """the keys of the exported issues in data_dir which have since been
+    resolved (or closed, on github), and so shouldn't be imported"""
+    github_state = load_export_state(data_dir, GITHUB_EXPORT_STATE_FILE)
+    return set(load_export_state(data_dir).get('resolved') or []) | set(
+        str(n) for n in github_state.get('closed') or []
+    )
+
+
+if __name__ == '__main__':
+    import shutil
+    import tempfile
+
+    def expect_eq(actual, expected, what):
+        assert actual == expected, \
+            "Expected %s to be %r but got %r" % (what, expected, actual)
+
+    def reopen(data_dir):
+        s = PackedStore(data_dir)
+        return (s, {k: s.get(k) for k in s.keys()})
+
+    data_dir = tempfile.mkdtemp()
+    try:
+        pack_path = os.path.join(data_dir, PACK_FILE)
+        index_path = os.path.join(data_dir, INDEX_FILE)
+        issues = {
+            'PROJ-%i' % i: {'key': 'PROJ-%i' % i, 'summary': 'issue %i' % i}
+            for i in range(1, 6)
+        }
+
+        store = PackedStore(data_dir, compress=True)
+        for (k, v) in issues.items():
+            store.put(k, v)
+        issues['PROJ-2'] = {'key': 'PROJ-2', 'summary': 'changed'}
+        expect_eq(store.put('PROJ-2', issues['PROJ-2']), True, 'put')
+        expect_eq(store.put('PROJ-3', issues['PROJ-3']), False, 'put')
+        store.close()
+        (store, got) = reopen(data_dir)
+        store.close()
+        expect_eq(got, issues, 'issues after reopening')
+
+        # the index is rebuilt if it is missing, or out of date
+        os.remove(index_path)
+        (store, got) = reopen(data_dir)
+        store.close()
+        expect_eq(got, issues, 'issues after rebuilding the index')
+        expect_eq(os.path.exists(index_path), True, 'index rewritten')
+
+        shutil.copy(index_path, index_path + '.bak')
+        store = PackedStore(data_dir)
+        store.put('PROJ-6', {'key': 'PROJ-6'})
+        store._file.close()   # crash without writing the index
+        os.replace(index_path + '.bak', index_path)
+        (store, got) = reopen(data_dir)
+        store.close()
+        expect_eq(got['PROJ-6'], {'key': 'PROJ-6'}, 'unindexed record')
+        issues['PROJ-6'] = got['PROJ-6']
+
+        # a truncated record at the end is dropped, and overwritten by the
+        # next put
+        store = PackedStore(data_dir)
+        store.put('PROJ-1', {'key': 'PROJ-1', 'summary': 'lost'})
+        store._file.close()
+        good_size = os.path.getsize(pack_path)
+        with open(pack_path, 'r+b') as f:
+            f.truncate(good_size - 3)
+        (store, got) = reopen(data_dir)
+        expect_eq(got, issues, 'issues after truncation')
+        store.put('PROJ-7', {'key': 'PROJ-7'})
+        issues['PROJ-7'] = {'key': 'PROJ-7'}
+        store.close()
+        (store, got) = reopen(data_dir)
+        store.close()
+        expect_eq(got, issues, 'issues after overwriting truncation')
+        os.remove(index_path)
+        (store, got) = reopen(data_dir)
+        store.close()
+        expect_eq(got, issues, 'issues after rescanning truncation')
+
+        # compaction drops the old records
+        size = os.path.getsize(pack_path)
+        store = PackedStore(data_dir)
+        reclaimed = store.compact()
+        expect_eq(os.path.getsize(pack_path), size - reclaimed, 'pack size')
+        expect_eq(reclaimed > 0, True, 'reclaimed anything')
+        store.put('PROJ-8', {'key': 'PROJ-8'})
+        issues['PROJ-8'] = {'key': 'PROJ-8'}
+        expect_eq({k: store.get(k) for k in store.keys()}, issues,
+                  'issues after compacting')
+        store.close()
+        (store, got) = reopen(data_dir)
+        expect_eq(store.compact(), 0, 'bytes reclaimed by second compaction')
+        store.close()
+        expect_eq(got, issues, 'issues after compacting and reopening')
+        os.remove(index_path)
+        (store, got) = reopen(data_dir)
+        store.close()
+        expect_eq(got, issues, 'issues after rebuilding compacted index')
+    finally:
+        shutil.rmtree(data_dir)
@@ -0,0 +1,378 @@
+import collections
+import concurrent.futures
+import datetime
+import itertools
+import logging
+import threading
+import zoneinfo
+
+import common
+import markdown_cache
+
+logger = logging.getLogger(__name__)
+
+# the number of issues we ask for in each search request. Jira will cap this
+# at its own jira.search.views.default.max setting.
+SEARCH_PAGE_SIZE = 1000
+
+# the issue fields used by the exporter. We ask jira for just these, rather
+# than '*all', so that we don't download every custom field.
+EXPORT_FIELDS = [
+    'summary',
+    'description',
+    'comment',
+    'attachment',
+    'issuelinks',
+    'reporter',
+    'watches',
+    'priority',
+    'issuetype',
+    'status',
+    'labels',
+    'created',
+    'updated',
+    'resolution',
+]
+
+
+def map_time(time):
+    """ Map from jira's time format to iso format (which github accepts).
+
+    Basically this just drops the millisecond component.
+    """
+    d = datetime.datetime.strptime(time, '%Y-%m-%dT%H:%M:%S.000%z')
+    return d.isoformat()
+
+
+class JiraExporter(object):
+    """Exports issues from a jira project, in the form we import to github
+
+    The export is done in stages, which add_stages() adds to a
+    pipeline.Pipeline; feed() then searches jira and feeds the issues into
+    the pipeline. The output of the last stage is a (jira key, issue data)
+    pair.
+
+    Unresolved issues are exported; the keys of the resolved issues we see
+    are kept in `resolved_issues`. Counts of the requests we made (and avoided
+    making) to jira are kept in `stats`.
+    """
+    def __init__(self, config, proj, search_concurrency=4):
+        self.config = config
+        self.proj = proj
+        self.search_concurrency = search_concurrency
+        self.resolved_issues = set()
+        self.stats = collections.Counter()
+        self._stats_lock = threading.Lock()
+        self.search_fields = ','.join(
+            EXPORT_FIELDS + (config.get('jira_extra_fields') or [])
+        )
+        self.markdown_cache = markdown_cache.MarkdownCache(
+            config.get('markdown_cache'),
+        )
+
+    @property
+    def jira_session(self):
+        return common.get_jira_session(self.config)
+
+    def add_stages(self, p, concurrency):
+        """add the export stages to a pipeline
+
+        concurrency is the number of threads making requests to jira.
+        """
+        p.add_stage('fetch', self.fetch_issue_extras, workers=concurrency)
+        p.add_stage('transform', self.transform_issue)
+        p.add_stage('markdown', self.convert_markup)
+
+    def feed(self, p, jql):
+        """search for the issues matched by jql, and put the unresolved ones
+        into the pipeline"""
+        for issue in self.search(jql):
+            if issue['fields']['resolution'] is not None:
+                if issue['key'] not in self.resolved_issues:
+                    logger.info("%s has been resolved", issue['key'])
+                    self.resolved_issues.add(issue['key'])
+                continue
+            self.resolved_issues.discard(issue['key'])
+            p.put(issue['key'], issue)
+
+    def map_user(self, user, fallback_to_display_name=True):
+        """Map a jira user object to a github @user
+
+        Takes a jira user object with 'name' and 'displayname' properties
+
+        Returns @githubuser, or just display name if fallback_to_display_name
+        is True, else None.
+        """
+        jira_id = user['name']
+        if jira_id in self.config['user_map']:
+            return "@" + self.config['user_map'][jira_id]
+
+        if fallback_to_display_name:
+            return user['displayName']
+
+        return None
+
+    def count_stat(self, name):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def get_watchers(self, watches):
+        """Get the list of github @users watching an issue
+
+        Takes the 'watches' field of a jira issue, and only asks jira for the
+        full list of watchers if it might contain someone in the user map.
+        """
+        user_map = self.config['user_map']
+        watch_count = watches['watchCount']
+        if watch_count == 0 or not user_map:
+            self.count_stat('watcher_requests_skipped')
+            return []
+
+        if watch_count == 1 and watches.get('isWatching'):
+            # the only watcher is the user we are logged in as.
+            self.count_stat('watcher_requests_skipped')
+            gh_user = user_map.get(self.config.get('jira_user'))
+            return ["@" + gh_user] if gh_user is not None else []
+
+        self.count_stat('watcher_requests')
+        resp = self.jira_session.get(watches['self'])
+        resp.raise_for_status()
+        r = resp.json()
+        watchers = []
+        for w in r['watchers']:
+            u = self.map_user(w, fallback_to_display_name=False)
+            if u is not None:
+                watchers.append(u)
+        return watchers
+
+    def fetch_issue_extras(self, issue):
+        """pipeline stage 1: fetch the bits of an issue which aren't in the
+        search results"""
+        issue_key = issue['key']
+        logger.info("Processing %s", issue_key)
+
+        # get external links. Jira doesn't tell us in the search results
+        # whether there are any, so we have to ask for each issue.
+        self.count_stat('remotelink_requests')
+        resp = self.jira_session.get(
+            self.config['jira_url'] + '/rest/api/2/issue/' + issue_key +
+            '/remotelink'
+        )
+        resp.raise_for_status()
+        r = resp.json()
+        remotelinks = {}
+        for l in r:
+            o = l['object']
+            remotelinks[o['title']] = o['url']
+
+        watchers = self.get_watchers(issue['fields']['watches'])
+        return (issue, remotelinks, watchers)
+
+    def transform_issue(self, item):
+        """pipeline stage 2: build the data for the github issue
+
+        The body and comments are left in jira markup, along with the text to
+        go after each of them once they have been converted. The rest of the
+        jira issue is dropped here.
+        """
+        (issue, remotelinks, watchers) = item
+        fields = issue['fields']
+
+        # build the body of the github issue
+        body_footer = "\n\n(Imported from {url})".format(
+            url=self.config['jira_url'] + "/browse/"+issue['key']
+        )
+        creator = fields['reporter']
+        if creator['name'] != 'neb':
+            body_footer += '\n\n(Reported by %s)' % self.map_user(creator)
+
+        # build comments for the github issue
+        comments = []
+        comment_footers = []
+        for comment in fields['comment']['comments']:
+            comments.append({
+                'created_at': map_time(comment['created']),
+                'body': comment['body'],
+            })
+            comment_footers.append(
+                "\n\n-- {user}".format(user=self.map_user(comment['author']))
+            )
+
+        # process attachments
+        attachments = []
+        for a in fields['attachment']:
+            # 'content' is actually the url.
+            attachments.append(a['content'])
+
+        # process issue links
+        links = []
+        for l in fields['issuelinks']:
+            if 'inwardIssue' in l:
+                direction = 'inward'
+                other = l['inwardIssue']
+            elif 'outwardIssue' in l:
+                direction = 'outward'
+                other = l['outwardIssue']
+            else:
+                raise Exception('link neither inward nor outward: %r' % l)
+            links.append({
+                'direction': direction,
+                'other': other['key'],
+                'type': l['type'][direction]
+            })
+
+        data = {
+            'title': fields['summary'],
+            'body': fields['description'],
+            'created_at': map_time(fields['created']),
+            'priority': fields['priority']['name'],
+            'type': fields['issuetype']['name'],
+            'status': fields['status']['name'],
+            'comments': comments,
+            'attachments': attachments,
+            'remotelinks': remotelinks,
+            'links': links,
+            'watchers': watchers,
+            'labels': fields['labels'],
+        }
+        return (issue['key'], data, body_footer, comment_footers)
+
+    def convert_markup(self, item):
+        """pipeline stage 3: convert the body and comments to markdown"""
+        (issue_key, data, body_footer, comment_footers) = item
+        to_markdown = self.markdown_cache.to_markdown
+        data['body'] = to_markdown(data['body']) + body_footer
+        for (comment, footer) in zip(data['comments'], comment_footers):
+            comment['body'] = to_markdown(comment['body']) + footer
+        return (issue_key, data)
+
+    def get_high_water_mark(self):
+        """Get the time of the most recent update to any issue in the project
+
+        Returns a string suitable for use in JQL, or None if there are no
+        issues.
+        """
+        result = self.jira_session.get(
+            self.config['jira_url'] + '/rest/api/2/search',
+            params={
+                'jql': 'project = {proj} ORDER BY updated DESC'.format(
+                    proj=self.proj,
+                ),
+                'fields': 'updated',
+                'maxResults': 1,
+            }
+        )
+        result.raise_for_status()
+        issues = result.json()['issues']
+        if not issues:
+            return None
+        d = datetime.datetime.strptime(
+            issues[0]['fields']['updated'], '%Y-%m-%dT%H:%M:%S.%f%z'
+        )
+
+        # JQL dates have no timezone: jira reads them in the user's timezone.
+        tz = self.get_timezone()
+        if tz is not None:
+            d = d.astimezone(tz)
+        return d.strftime('%Y/%m/%d %H:%M')
+
+    def get_timezone(self):
+        """Get the timezone jira uses for the user we are logged in as
+
+        Returns None if we aren't logged in, in which case jira uses its
+        default timezone, which is also the one it gives us times in.
+        """
+        if 'jira_password' not in self.config:
+            return None
+        result = self.jira_session.get(
+            self.config['jira_url'] + '/rest/api/2/myself'
+        )
+        result.raise_for_status()
+        tz_name = result.json()['timeZone']
+        try:
+            return zoneinfo.ZoneInfo(tz_name)
+        except zoneinfo.ZoneInfoNotFoundError:
+            # use the earliest timezone there is: we may re-export a few
+            # issues, but won't miss any.
+            logger.warning("Unknown jira timezone %s", tz_name)
+            return datetime.timezone(datetime.timedelta(hours=-12))
+
+    def jql_for_keys(self, keys):
+        """JQL queries for the given issues, in batches"""
+        keys = sorted(keys, key=common.sort_jira_key)
+        for i in range(0, len(keys), common.KEY_BATCH_SIZE):
+            yield (
+                'project = {proj} AND key in ({keys}) ORDER BY id ASC'.format(
+                    proj=self.proj,
+                    keys=', '.join(keys[i:i + common.KEY_BATCH_SIZE]),
+                )
+            )
+
+    def fetch_search_page(self, jql, start_at):
+        logger.debug("Fetching search results from %i", start_at)
+        result = self.jira_session.get(
+            self.config['jira_url'] + '/rest/api/2/search',
+            params={
+                'jql': jql,
+                'fields': self.search_fields,
+                'startAt': start_at,
+                'maxResults': SEARCH_PAGE_SIZE,
+                # don't fail if we ask for an issue which has since been
+                # deleted
+                'validateQuery': 'warn',
+            }
+        )
+        result.raise_for_status()
+        return result.json()
+
+    def search(self, jql):
+        """yield the issues matched by jql"""
+        search_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.search_concurrency,
+        )
+
+        # the first page tells us how many issues there are, and how many jira
+        # is prepared to give us per page; we can then fetch the rest of the
+        # pages in parallel.
+        r = self.fetch_search_page(jql, 0)
+        page_size = r['maxResults'] or len(r['issues'])
+        logger.info("Exporting %i issues, %i per page", r['total'], page_size)
+
+        offsets = iter(range(page_size, r['total'], page_size))
+        pending_pages = collections.deque(
+            search_executor.submit(self.fetch_search_page, jql, start_at)
+            for start_at in itertools.islice(offsets, self.search_concurrency)
+        )
+
+        while True:
+            for issue in r['issues']:
+                yield issue
+
+            if not pending_pages:
+                break
+
+            # keep search_concurrency pages in flight, but hand them to the
+            # exporters in order.
+            r = pending_pages.popleft().result()
+            start_at = next(offsets, None)
+            if start_at is not None:
+                pending_pages.append(search_executor.submit(
+                    self.fetch_search_page, jql, start_at,
+                ))
+
+        search_executor.shutdown(wait=True)
+
+    def close(self):
+        self.markdown_cache.close()
+
+    def log_stats(self):
+        logger.info(
+            "Made %i remotelink requests and %i watcher requests; "
+            "skipped %i watcher requests; %i issues were unchanged",
+            self.stats['remotelink_requests'], self.stats['watcher_requests'],
+            self.stats['watcher_requests_skipped'],
+            self.stats['unchanged_issues'],
+        )
+        self.markdown_cache.log_stats()
+        if common.get_http_cache(self.config) is not None:
+            common.get_http_cache(self.config).log_stats()
@@ -1,18 +1,53 @@
 import re
 
-
-def sub_markup(text, input_leader, output_leader,
-               input_trailer=None, output_trailer=None):
-
+# bump this whenever a change to the converter changes its output, so that
+# cached conversions (see markdown_cache.py) are thrown away.
+CONVERTER_VERSION = 2
+
+
+class _Rule(object):
+    """A conversion rule for the tokenizer.
+
+    leader is a regex which finds the places where the rule might match. It
+    must start with a literal character, and no two rules' leaders may match at
+    the same place.
+
+    pattern is the regex for the whole of the text to be converted, starting
+    from the leader; convert is called with its match object to get the
+    replacement text.
+
+    If the pattern fails to match after a leader, it must also fail after any
+    later leader on the same line (or, if multiline is set, anywhere later in
+    the text). This lets us skip the remaining leaders rather than scanning
+    for the rest of the pattern over and over again.
+    """
+    def __init__(self, name, leader, pattern, convert, multiline=False):
+        self.name = name
+        self.leader = leader
+        self.pattern = pattern
+        self.regex = re.compile(pattern)
+        self.convert = convert
+        self.multiline = multiline
+
+
+def _markup_rule(name, input_leader, output_leader,
+                 input_trailer=None, output_trailer=None):
     if input_trailer is None:
         input_trailer = input_leader
     if output_trailer is None:
         output_trailer = output_leader
 
-    matcher = (
-        r'(?<!\w)'            # negative look-behind assertion: checks that the
-                              # previous character is not a word character.
-        + re.escape(input_leader)
+    leader = (
+        re.escape(input_leader)
+        + r'(?<!\w' + re.escape(input_leader) + ')'
+                              # negative look-behind assertion: checks that the
+                              # character before the leader is not a word
+                              # character.
+        + r'(?=\S)'           # the body must start with a non-space character
+    )
+
+    pattern = (
+        re.escape(input_leader)
         + r'(\w|\S.*?\S)'     # body: either a single word character, or a
                               # series of two or more non-newlines which start
                               # and end with a non-space character
@@ -21,67 +56,184 @@ def sub_markup(text, input_leader, output_leader,
                               # next character is not a word character.
     )
 
-    replacement = (
-        output_leader + r'\1' + output_trailer
-    )
+    def convert(text, m, excluded):
+        return (
+            output_leader
+            + _convert(text, m.start(1), m.end(1), excluded)
+            + output_trailer
+        )
 
-    return re.sub(matcher, replacement, text)
+    return _Rule(name, leader, pattern, convert)
 
 
-def to_markdown(text):
-    if text is None:
-        return ""
+def _convert_code(text, m, excluded):
+    return '```' + (m.group(1) or '')
 
-    text = text.replace('\r\n', '\n')
 
-    # suffix @ with zwsp to stop github linkifying
-    text = text.replace('@', '@&#8203;')
+def _convert_quote(text, m, excluded):
+    body = _convert(text, m.start(1), m.end(1), excluded)
+    return _line_start.sub('>', body) + "\n\n"
+
+
+def _convert_link(text, m, excluded):
+    return '[%s](%s)' % (
+        _convert(text, m.start(1), m.end(1), excluded),
+        _convert(text, m.start(2), m.end(2), excluded),
+    )
 
-    # header text
-    def header(m):
-        return '#' * int(m.group(1))
-    text = re.sub(r'^h([0-6])\.', header, text, 0, re.M)
 
+# the rules are listed in the order that they used to be applied as separate
+# passes over the text.
+_rules = [
     # *bold*
-    text = sub_markup(text, '*', '**')
+    _markup_rule('bold', '*', '**'),
 
     # _underlined_ needs no change
 
     # {{monospaced}}
-    text = sub_markup(text, '{{', '`', '}}', '`')
+    _markup_rule('monospaced', '{{', '`', '}}', '`'),
 
     # ??citation??
-    text = sub_markup(text, '??', '<cite>', '??', '</cite>')
+    _markup_rule('citation', '??', '<cite>', '??', '</cite>'),
 
     # +inserted+
-    text = sub_markup(text, '+', '<ins>', '+', '</ins>')
+    _markup_rule('inserted', '+', '<ins>', '+', '</ins>'),
 
     # ^superscript^
-    text = sub_markup(text, '^', '<sup>', '^', '</sup>')
+    _markup_rule('superscript', '^', '<sup>', '^', '</sup>'),
 
     # ~subscript~
-    text = sub_markup(text, '~', '<sub>', '~', '</sub>')
+    _markup_rule('subscript', '~', '<sub>', '~', '</sub>'),
 
     # -strikethrough-
-    text = sub_markup(text, '-', '~~')
+    _markup_rule('strikethrough', '-', '~~'),
+
+    # code quote. Any spaces before the {code} are removed by _convert.
+    _Rule(
+        'code',
+        r'\{(?=code|noformat\})',
+        r'\{(?:code(?::([a-z]+)\}|[^}]*\})|noformat\})',
+        _convert_code,
+        multiline=True,
+    ),
+
+    _Rule(
+        'quote',
+        r'\{(?=quote\}\n)',
+        r'\{quote\}\n+([\s\S]*?)\n\{quote\}\n*',
+        _convert_quote,
+        multiline=True,
+    ),
 
-    # code quote
-    text = re.sub(r' *{code:([a-z]+)}', r'```\1', text)
-    text = re.sub(r' *{code[^}]*}', r'```', text)
-    text = re.sub(r' *{noformat}', r'```', text)
+    # hyperlinks
+    _Rule(
+        'link',
+        r'\[(?<!\w\[)(?=.)',
+        r'\[(.[^|\n]*)\|(.+?)\](?!\w)',  # only the first | can match
+        _convert_link,
+    ),
+]
+
+
+def _compile_tokenizer(rules):
+    """Build a single regex which matches the leader of any of the rules.
+
+    Returns the compiled regex, and a map from the index of the group which
+    ends each alternative to its rule.
+    """
+    alternatives = []
+    rules_by_group = {}
+    for group, rule in enumerate(rules, 1):
+        # each alternative ends with an empty group, so that match.lastindex
+        # tells us which one matched.
+        alternatives.append(rule.leader + '()')
+        rules_by_group[group] = rule
+
+    return re.compile('|'.join(alternatives)), rules_by_group
+
+
+_tokenizer, _rules_by_group = _compile_tokenizer(_rules)
+_header = re.compile(r'^h([0-6])\.', re.M)
+_line_start = re.compile('^', re.M)
+
+
+def _convert(text, pos, endpos, excluded=frozenset()):
+    """Convert text[pos:endpos] in a single pass.
+
+    excluded is the set of rules which are not applied to this part of the
+    text, because it is within the body of a match of that rule.
+    """
+    result = []
+
+    # map from rule to the position before which we know it can't match
+    no_match_before = {}
+
+    while True:
+        t = _tokenizer.search(text, pos, endpos)
+        if t is None:
+            break
+
+        rule = _rules_by_group[t.lastindex]
+        start = t.start()
+        m = None
+        if rule not in excluded and no_match_before.get(rule, 0) <= start:
+            m = rule.regex.match(text, start, endpos)
+            if m is None:
+                end = -1 if rule.multiline else text.find('\n', start, endpos)
+                no_match_before[rule] = endpos if end == -1 else end
+
+        if m is None:
+            # no other rule can match here, so just step over the leader.
+            result.append(text[pos:start + 1])
+            pos = start + 1
+            continue
+
+        if rule.name == 'code':
+            result.append(text[pos:start].rstrip(' '))
+        else:
+            result.append(text[pos:start])
+        result.append(rule.convert(text, m, excluded | {rule}))
+        pos = m.end()
+
+    result.append(text[pos:endpos])
+    return ''.join(result)
 
-    def quote(m):
-        return re.sub('^', '>', m.group(1), 0, re.M)+"\n\n"
-    text = re.sub(r'{quote}\n+(.*?)\n{quote}\n*', quote, text, 0, re.S)
 
-    # hyperlinks
-    text = re.sub(r'(?<!\w)\[(.+?)\|(.+?)\](?!\w)', r'[\1](\2)', text)
-    # text = re.sub(r'\[(.+?)\]([^\(]*)', r'<\1>\2', text)
+def to_markdown(text):
+    """Convert jira markup to github markdown
+
+    This gives the same output as the old converter, which made a separate
+    re.sub pass over the text for each rule, for any markup which nests
+    properly (the self-tests check this over a generated corpus). Where two
+    pieces of markup overlap rather than nest, the old converter converted
+    both, and produced mis-nested output; we convert the first, and leave the
+    markup characters in its body which aren't closed within it:
+
+        *a -b* c-      ->  **a -b** c-      (was **a ~~b** c~~)
+        {{a *b}} c*    ->  `a *b` c*        (was `a **b` c**)
+        [*a|b*]        ->  [*a](b*)         (was [**a](b**))
+        *x [a|b* c]    ->  **x [a|b** c]    (was **x [a](b** c))
+        {{{code}}}     ->  `{code`}         (was ````)
+    """
+    if text is None:
+        return ""
 
-    return text
+    text = text.replace('\r\n', '\n')
+
+    # suffix @ with zwsp to stop github linkifying
+    text = text.replace('@', '@&#8203;')
+
+    # header text
+    def header(m):
+        return '#' * int(m.group(1))
+    text = _header.sub(header, text)
+
+    return _convert(text, 0, len(text))
 
 
 if __name__ == '__main__':
+    import random
+
     def expect_eq(input, expected_output):
         actual = to_markdown(input)
         assert actual == expected_output, \
@@ -89,6 +241,126 @@ if __name__ == '__main__':
                 input, expected_output, actual
             )
 
+    def reference_sub_markup(text, input_leader, output_leader,
+                             input_trailer=None, output_trailer=None):
+        if input_trailer is None:
+            input_trailer = input_leader
+        if output_trailer is None:
+            output_trailer = output_leader
+
+        matcher = (
+            r'(?<!\w)'
+            + re.escape(input_leader)
+            + r'(\w|\S.*?\S)'
+            + re.escape(input_trailer)
+            + r'(?!\w)'
+        )
+        replacement = (
+            output_leader + r'\1' + output_trailer
+        )
+        return re.sub(matcher, replacement, text)
+
+    def reference_to_markdown(text):
+        """the original converter, with a separate pass for each rule"""
+        if text is None:
+            return ""
+
+        text = text.replace('\r\n', '\n')
+        text = text.replace('@', '@&#8203;')
+
+        def header(m):
+            return '#' * int(m.group(1))
+        text = re.sub(r'^h([0-6])\.', header, text, 0, re.M)
+
+        text = reference_sub_markup(text, '*', '**')
+        text = reference_sub_markup(text, '{{', '`', '}}', '`')
+        text = reference_sub_markup(text, '??', '<cite>', '??', '</cite>')
+        text = reference_sub_markup(text, '+', '<ins>', '+', '</ins>')
+        text = reference_sub_markup(text, '^', '<sup>', '^', '</sup>')
+        text = reference_sub_markup(text, '~', '<sub>', '~', '</sub>')
+        text = reference_sub_markup(text, '-', '~~')
+
+        text = re.sub(r' *{code:([a-z]+)}', r'```\1', text)
+        text = re.sub(r' *{code[^}]*}', r'```', text)
+        text = re.sub(r' *{noformat}', r'```', text)
+
+        def quote(m):
+            return re.sub('^', '>', m.group(1), 0, re.M)+"\n\n"
+        text = re.sub(r'{quote}\n+(.*?)\n{quote}\n*', quote, text, 0, re.S)
+
+        text = re.sub(r'(?<!\w)\[(.+?)\|(.+?)\](?!\w)', r'[\1](\2)', text)
+        return text
+
+    # a generated corpus of properly nested markup, on which we must give
+    # the same output as the reference converter.
+    rnd = random.Random(0)
+    corpus_words = [
+        'the', 'room', 'sync', 'PROJ-123', 'a_b', 'x', 'user@example.com',
+        'http://example.com/some-path', 'x-y', '2*3', 'a+b',
+    ]
+    inline = [
+        ('*', '*'), ('{{', '}}'), ('??', '??'), ('+', '+'), ('^', '^'),
+        ('~', '~'), ('-', '-'),
+    ]
+
+    def gen_words():
+        return ' '.join(
+            rnd.choice(corpus_words) for _ in range(rnd.randint(1, 4))
+        )
+
+    def gen_markup(depth=0, used=()):
+        (leader, trailer) = rnd.choice([m for m in inline if m not in used])
+        body = gen_words()
+        if depth < 2 and rnd.random() < 0.4:
+            body += ' ' + gen_markup(depth + 1, used + ((leader, trailer),))
+        return leader + body + trailer
+
+    def gen_line():
+        parts = []
+        for _ in range(rnd.randint(1, 8)):
+            r = rnd.random()
+            if r < 0.5:
+                parts.append(gen_words())
+            elif r < 0.85:
+                parts.append(gen_markup())
+            else:
+                parts.append('[%s|http://example.com/%s]' % (
+                    rnd.choice([gen_words, gen_markup])(), gen_words(),
+                ))
+        line = ' '.join(parts)
+        if rnd.random() < 0.1:
+            line = 'h%i. %s' % (rnd.randint(1, 6), line)
+        return line
+
+    def gen_doc():
+        blocks = []
+        for _ in range(rnd.randint(1, 4)):
+            r = rnd.random()
+            lines = [gen_line() for _ in range(rnd.randint(1, 4))]
+            if r < 0.15:
+                blocks.append('{quote}\n%s\n{quote}' % '\n'.join(lines))
+            elif r < 0.3:
+                blocks.append('%s{%s}\n%s\n%s{code}' % (
+                    ' ' * rnd.randint(0, 4),
+                    rnd.choice(['code', 'code:java', 'noformat']),
+                    '\n'.join(lines), ' ' * rnd.randint(0, 4),
+                ))
+            else:
+                blocks.append('\n'.join(lines))
+        return rnd.choice(['\n', '\r\n', '\n\n']).join(blocks)
+
+    for _ in range(2000):
+        doc = gen_doc()
+        expect_eq(doc, reference_to_markdown(doc))
+
+    # where markup overlaps rather than nests, we deliberately differ from
+    # the reference converter: see the docstring of to_markdown.
+    expect_eq("*a -b* c-", "**a -b** c-")
+    expect_eq("{{a *b}} c*", "`a *b` c*")
+    expect_eq("[*a|b*]", "[*a](b*)")
+    expect_eq("*x [a|b* c]", "**x [a|b** c]")
+    expect_eq("{{{code}}}", "`{code`}")
+
     expect_eq("*bold*", "**bold**")
     expect_eq("-strike- me -down-", "~~strike~~ me ~~down~~")
 
@@ -132,3 +404,50 @@ there
 
 there
 """)
+
+    # golden outputs from the original sequential re.sub implementation, which
+    # the single-pass converter must reproduce.
+    expect_eq("h1. Title\nh3.sub", "# Title\n###sub")
+    expect_eq(
+        "{{monospaced}} and ??cite?? and +ins+ and ^sup^ and ~sub~",
+        "`monospaced` and <cite>cite</cite> and <ins>ins</ins> and "
+        "<sup>sup</sup> and <sub>sub</sub>",
+    )
+    expect_eq(
+        "a*not bold* x-y-z under_score_d",
+        "a*not bold* x-y-z under_score_d",
+    )
+    expect_eq(
+        "*bold with {{mono}} inside* and -strike *bold*-",
+        "**bold with `mono` inside** and ~~strike **bold**~~",
+    )
+    expect_eq("{{*bold* inside mono}}", "`**bold** inside mono`")
+    expect_eq(
+        "* not bold *, - not struck -, lone * and -",
+        "* not bold *, - not struck -, lone * and -",
+    )
+    expect_eq(
+        "user@example.com mentions @someone",
+        "user@&#8203;example.com mentions @&#8203;someone",
+    )
+    expect_eq("line one\r\nline two\r\n", "line one\nline two\n")
+    expect_eq("{code:java}\nint x = 1;\n{code}", "```java\nint x = 1;\n```")
+    expect_eq("{code:Java|title=x}\nfoo\n{code}", "```\nfoo\n```")
+    expect_eq("  {noformat}\n*raw*\n  {noformat}", "```\n**raw**\n```")
+    expect_eq(
+        "see [the docs|http://example.com/a-b] and [PROJ-1]",
+        "see [the docs](http://example.com/a-b) and [PROJ-1]",
+    )
+    expect_eq(
+        "[*bold link*|http://example.com]",
+        "[**bold link**](http://example.com)",
+    )
+    expect_eq(
+        "{quote}\n*quoted* text\nwith [link|http://x]\n{quote}\nafter",
+        ">**quoted** text\n>with [link](http://x)\n\nafter",
+    )
+    expect_eq(
+        "-http://example.com/some-path-",
+        "~~http://example.com/some-path~~",
+    )
+    expect_eq("x^2^ and H~2~O", "x^2^ and H~2~O")
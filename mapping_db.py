@@ -0,0 +1,120 @@
+import logging
+import os
+import os.path
+import threading
+
+import yaml
+
+logger = logging.getLogger(__name__)
+
+LOG_FILE = 'issue_mapping.log'
+YAML_FILE = 'issue_mapping.yaml'
+
+
+class MappingDb(object):
+    """The mapping from jira key to github issue (as 'user/proj/issues/N')
+
+    The mapping is kept in an append-only log file, with one tab-separated
+    line per issue, so each entry is on disk as soon as the import resolves.
+    The whole log is read into a dict when it is opened; later lines override
+    earlier ones.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._mapping = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    # ignore any partial line left by a crash
+                    if not line.endswith('\n') or '\t' not in line:
+                        continue
+                    (k, v) = line[:-1].split('\t', 1)
+                    self._mapping[k] = v
+        self._log = None
+
+    def __getitem__(self, jira_key):
+        return self._mapping[jira_key]
+
+    def __contains__(self, jira_key):
+        return jira_key in self._mapping
+
+    def __len__(self):
+        return len(self._mapping)
+
+    def get(self, jira_key, default=None):
+        return self._mapping.get(jira_key, default)
+
+    def keys(self):
+        return self._mapping.keys()
+
+    def items(self):
+        return self._mapping.items()
+
+    def add(self, jira_key, github_issue):
+        """record the github issue for a jira key, if it has changed"""
+        with self._lock:
+            if self._mapping.get(jira_key) == github_issue:
+                return
+            if self._log is None:
+                self._log = open(self.path, 'a')
+            self._log.write('%s\t%s\n' % (jira_key, github_issue))
+            self._log.flush()
+            self._mapping[jira_key] = github_issue
+
+    def export_yaml(self, path):
+        """write the mapping as a yaml file, as older versions did"""
+        dumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            yaml.dump(dict(self._mapping), f, Dumper=dumper,
+                      default_flow_style=False)
+        os.replace(tmp, path)
+
+    def close(self):
+        if self._log is not None:
+            self._log.close()
+
+
+def open_mapping_db(data_dir, create=False):
+    """Open the issue mapping in data_dir
+
+    If there is no mapping log yet, but there is an issue_mapping.yaml (as
+    written by older versions of import-github-issues.py), the mapping is
+    read from that instead. With create, which is for the scripts which do
+    the importing, the log is populated from the yaml file, or started empty
+    if there isn't one; otherwise, having no mapping at all is an error.
+    """
+    path = os.path.join(data_dir, LOG_FILE)
+    yaml_path = os.path.join(data_dir, YAML_FILE)
+    if os.path.exists(path):
+        return MappingDb(path)
+
+    if not os.path.exists(yaml_path):
+        if not create:
+            raise Exception(
+                "No issue mapping (%s or %s) in %s: has "
+                "import-github-issues.py been run?" % (
+                    LOG_FILE, YAML_FILE, data_dir,
+                )
+            )
+        return MappingDb(path)
+
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    with open(yaml_path) as f:
+        old = yaml.load(f, Loader=loader) or {}
+
+    if not create:
+        mapping = MappingDb(path)
+        mapping._mapping.update(old)
+        return mapping
+
+    # write the log under another name, and only move it into place once it
+    # is complete, so that if we fail part way the migration is tried again.
+    logger.info("Migrating %s to %s", yaml_path, path)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        for (k, v) in old.items():
+            f.write('%s\t%s\n' % (k, v))
+    os.replace(tmp_path, path)
+    return MappingDb(path)
@@ -0,0 +1,104 @@
+import collections
+import hashlib
+import logging
+import sqlite3
+import threading
+
+import jira_to_markdown
+
+logger = logging.getLogger(__name__)
+
+# the number of new conversions to write to the database in each transaction
+_COMMIT_EVERY = 100
+
+
+class MarkdownCache(object):
+    """A cache of jira_to_markdown.to_markdown results
+
+    Conversions are keyed by a hash of the input text and the converter
+    version. The most recently used max_entries are kept in memory; if path is
+    given, every conversion is also stored in a sqlite database there, so
+    that later runs can skip converting text which hasn't changed.
+
+    Counts of cache hits and misses are kept in `stats`.
+    """
+    def __init__(self, path=None, max_entries=10000):
+        self.max_entries = max_entries
+        self.stats = collections.Counter()
+        self._lru = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._uncommitted = 0
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS markdown (
+                    key TEXT PRIMARY KEY,
+                    markdown TEXT
+                )
+            """)
+            self._db.commit()
+
+    def to_markdown(self, text):
+        if not text:
+            return jira_to_markdown.to_markdown(text)
+
+        key = _cache_key(text)
+        with self._lock:
+            result = self._lru.get(key)
+            if result is not None:
+                self._lru.move_to_end(key)
+                self.stats['hits'] += 1
+                return result
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT markdown FROM markdown WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    self.stats['disk_hits'] += 1
+                    self._remember(key, row[0])
+                    return row[0]
+
+        result = jira_to_markdown.to_markdown(text)
+
+        with self._lock:
+            self.stats['misses'] += 1
+            self._remember(key, result)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO markdown (key, markdown)"
+                    " VALUES (?, ?)", (key, result),
+                )
+                self._uncommitted += 1
+                if self._uncommitted >= _COMMIT_EVERY:
+                    self._commit()
+        return result
+
+    def close(self):
+        if self._db is not None:
+            with self._lock:
+                self._commit()
+            self._db.close()
+
+    def log_stats(self):
+        logger.info(
+            "markdown cache: %i hits, %i from disk, %i misses",
+            self.stats['hits'], self.stats['disk_hits'],
+            self.stats['misses'],
+        )
+
+    def _remember(self, key, result):
+        self._lru[key] = result
+        if len(self._lru) > self.max_entries:
+            self._lru.popitem(last=False)
+
+    def _commit(self):
+        self._db.commit()
+        self._uncommitted = 0
+
+
+def _cache_key(text):
+    h = hashlib.sha256()
+    h.update(b'%i\0' % jira_to_markdown.CONVERTER_VERSION)
+    h.update(text.encode('utf-8'))
+    return h.hexdigest()
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+#
+# usage: migrate-jira-issues.py <PROJ> <user>/<project>
+#
+# exports the unresolved issues from a jira project and imports them to
+# github in one go: each issue is submitted for import as soon as it has been
+# exported, rather than waiting for the whole export to finish.
+#
+# this does the work of export-jira-issues.py followed by
+# import-github-issues.py. The exported issues, import statuses and issue
+# mapping are written to the data directory as they would be by those
+# scripts, so update-github-links.py etc can be run afterwards, and it is
+# safe to re-run on failure.
+
+import argparse
+import logging
+import os.path
+import yaml
+
+import common
+import github_import
+import issue_store
+import jira_export
+import mapping_db
+import pipeline
+import status_db
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+parser = argparse.ArgumentParser()
+parser.add_argument('proj', metavar='PROJ', help='Jira project key')
+parser.add_argument(
+    'github_proj', metavar='user/proj', help='Github project'
+)
+parser.add_argument('--debug', '-d', action='store_true')
+parser.add_argument(
+    '--data-dir', default='data',
+    help='destination directory for exported issues. (default: %(default)s)'
+)
+parser.add_argument(
+    '--concurrency', type=int, default=10,
+    help='maximum number of concurrent requests to jira. '
+         '(default: %(default)s)'
+)
+parser.add_argument(
+    '--search-concurrency', type=int, default=4,
+    help='maximum number of search result pages to fetch at once. '
+         '(default: %(default)s)'
+)
+parser.add_argument(
+    '--import-concurrency', type=int, default=4,
+    help='maximum number of import requests to send at once. '
+         '(default: %(default)s)'
+)
+parser.add_argument(
+    '--ordered', action='store_true',
+    help='export and import the issues one at a time, so that the github '
+         'issue numbers are in the same order as the jira keys'
+)
+parser.add_argument(
+    '--retries', type=int, default=2,
+    help='number of times to retry issues which fail. (default: %(default)s)'
+)
+parser.add_argument(
+    '--no-old-issue-number', default=False, action='store_true',
+    help="Disable the inclusion of the old issue number in the new issue's "
+         "title",
+)
+parser.add_argument(
+    '--store-format', choices=issue_store.FORMATS,
+    help='how to store the exported issues: one yaml file per issue, or '
+         'packed into a single file. (default: whichever is already in the '
+         'data directory, or yaml)'
+)
+parser.add_argument(
+    '--compress', action='store_true',
+    help='compress the issues in a packed store'
+)
+args = parser.parse_args()
+
+if args.debug:
+    logging.getLogger().setLevel(logging.DEBUG)
+
+with open("config.yaml") as conf:
+    config = yaml.safe_load(conf)
+
+# in ordered mode, every stage has a single worker, so the issues reach the
+# import stage in the order of the search results.
+concurrency = 1 if args.ordered else args.concurrency
+import_concurrency = 1 if args.ordered else args.import_concurrency
+
+common.get_jira_session(
+    config, pool_size=concurrency + args.search_concurrency,
+)
+github_session = common.get_github_session(
+    config, accept='application/vnd.github.golden-comet-preview+json',
+    pool_size=max(10, import_concurrency),
+)
+
+exporter = jira_export.JiraExporter(
+    config, args.proj, search_concurrency=args.search_concurrency,
+)
+importer = github_import.GithubImporter(
+    config, github_session, args.github_proj,
+    old_issue_number=not args.no_old_issue_number,
+)
+
+store = issue_store.open_issue_store(
+    args.data_dir, args.store_format, compress=args.compress,
+)
+status = status_db.open_status_db(args.data_dir)
+logger.info("Import statuses: %s", status.counts())
+issue_mapping = mapping_db.open_mapping_db(args.data_dir, create=True)
+
+
+def write_issue(item):
+    """pipeline stage: write the exported issue to the store"""
+    (issue_key, data) = item
+    if not store.put(issue_key, data):
+        exporter.count_stat('unchanged_issues')
+    return item
+
+
+def import_issue(item):
+    """pipeline stage: start the import of an issue, unless that has already
+    been done"""
+    (issue_key, data) = item
+    stat = status.get(issue_key, {}).get('status')
+    if stat == 'imported' or stat == 'pending':
+        return None
+
+    result = importer.submit_import(
+        issue_key, importer.build_import(issue_key, data),
+    )
+    issueStatus = status.get(issue_key, {})
+    issueStatus.update(result)
+    status[issue_key] = issueStatus
+    status.flush()
+
+
+# in ordered mode, the issues which we haven't imported because an issue
+# before them failed
+held_issues = set()
+
+
+def migrate_issues(jql):
+    """export and start importing the issues matched by jql
+
+    Returns a map from jira key to exception for the issues which failed.
+    """
+    p = pipeline.Pipeline(queue_size=concurrency * 2)
+    exporter.add_stages(p, concurrency)
+    p.add_stage('write', write_issue)
+
+    if args.ordered:
+        def import_in_order(item):
+            # once an issue has failed, hold back the ones after it, and
+            # import them once it has been retried.
+            if p.failures or held_issues:
+                held_issues.add(item[0])
+                return None
+            return import_issue(item)
+        p.add_stage('import', import_in_order)
+    else:
+        p.add_stage('import', import_issue, workers=import_concurrency)
+    p.start()
+    exporter.feed(p, jql)
+    p.close()
+    return p.failures
+
+
+failures = migrate_issues("""
+project = {proj} AND resolution IS EMPTY ORDER BY key ASC
+""".format(proj=args.proj))
+
+for attempt in range(args.retries):
+    if not failures:
+        break
+    logger.info("Retrying %i failed issues", len(failures))
+    retry_failures = {}
+    for q in exporter.jql_for_keys(failures):
+        retry_failures.update(migrate_issues(q))
+    failures = retry_failures
+
+# import the issues we held back, in order, stopping at the first issue
+# which still hasn't been exported: the ones after it have to wait for the
+# next run.
+for issue_key in sorted(held_issues, key=common.sort_jira_key):
+    first_failure = min(failures, key=common.sort_jira_key, default=None)
+    if first_failure is not None and (
+        common.sort_jira_key(issue_key) > common.sort_jira_key(first_failure)
+    ):
+        logger.info("Not importing the issues after %s", first_failure)
+        break
+    try:
+        import_issue((issue_key, store.get(issue_key)))
+    except Exception as e:
+        logger.exception("Error importing %s", issue_key)
+        failures[issue_key] = e
+
+store.close()
+exporter.close()
+exporter.log_stats()
+
+# wait for all the imports we started (or which were left over from a
+# previous run) to finish.
+importer.wait_for_imports(status, status.items(), issue_mapping)
+
+issue_mapping.export_yaml(
+    os.path.join(args.data_dir, mapping_db.YAML_FILE)
+)
+issue_mapping.close()
+status.close()
+github_session.log_stats()
+
+if failures:
+    raise Exception("Failed to migrate issues: %s" % ', '.join(
+        sorted(failures, key=common.sort_jira_key)
+    ))
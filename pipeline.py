@@ -0,0 +1,111 @@
+import collections
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+# put on a stage's input queue to tell one of its workers to stop
+_STOP = object()
+
+
+class Pipeline(object):
+    """A chain of processing stages, connected by bounded queues
+
+    Items are put() into the first stage, along with a key which identifies
+    them (such as the jira key). Each stage has a number of worker threads
+    which call its function on each item; the result is passed on to the next
+    stage, unless it is None, in which case the item is dropped.
+
+    Since the queues are bounded, put() blocks when the stages can't keep up,
+    so the number of items in memory at once stays fixed however many are fed
+    in.
+
+    If a stage raises an exception for an item, the error is logged and
+    recorded in `failures`, a map from key to exception, and the item is
+    dropped. The number of items which have completed each stage is counted
+    in `stats`.
+    """
+    def __init__(self, queue_size=10):
+        self.queue_size = queue_size
+        self.failures = collections.OrderedDict()
+        self.stats = collections.Counter()
+        self._stages = []
+        self._lock = threading.Lock()
+        self._started = False
+
+    def add_stage(self, name, fn, workers=1):
+        """add a stage which calls fn(item) in each of `workers` threads"""
+        assert not self._started
+        self._stages.append(_Stage(name, fn, workers, self.queue_size))
+
+    def start(self):
+        self._started = True
+        for (i, stage) in enumerate(self._stages):
+            stage.threads = [
+                threading.Thread(
+                    target=self._run_worker, args=(i,),
+                    name='%s-%i' % (stage.name, n),
+                    daemon=True,
+                )
+                for n in range(stage.workers)
+            ]
+            for t in stage.threads:
+                t.start()
+
+    def put(self, key, item):
+        """feed an item into the first stage, waiting for space if need be"""
+        self._stages[0].queue.put((key, item))
+
+    def close(self):
+        """wait for every item to work its way through the pipeline"""
+        self._stop_stage(0)
+        for stage in self._stages:
+            for t in stage.threads:
+                t.join()
+
+    def _stop_stage(self, i):
+        stage = self._stages[i]
+        for _ in range(stage.workers):
+            stage.queue.put(_STOP)
+
+    def _run_worker(self, i):
+        stage = self._stages[i]
+        next_stage = (
+            self._stages[i + 1] if i + 1 < len(self._stages) else None
+        )
+        while True:
+            entry = stage.queue.get()
+            if entry is _STOP:
+                break
+            (key, item) = entry
+            try:
+                result = stage.fn(item)
+            except Exception as e:
+                logger.exception("Error in %s stage for %s", stage.name, key)
+                with self._lock:
+                    self.failures[key] = e
+                continue
+
+            with self._lock:
+                self.stats[stage.name] += 1
+            if result is not None and next_stage is not None:
+                next_stage.queue.put((key, result))
+
+        # when the last worker in a stage finishes, everything it produced is
+        # queued for the next stage, so that can be told to stop too.
+        with self._lock:
+            stage.running -= 1
+            last = stage.running == 0
+        if last and next_stage is not None:
+            self._stop_stage(i + 1)
+
+
+class _Stage(object):
+    def __init__(self, name, fn, workers, queue_size):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.running = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.threads = []
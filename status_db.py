@@ -0,0 +1,137 @@
+import glob
+import json
+import logging
+import os.path
+import shelve
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class StatusDb(object):
+    """The state database used by import-github-issues.py
+
+    Records the github import status for each jira issue:
+
+        {
+          status: pending | imported | failed,
+          url: gh import status url,
+          issue_url: github issue url (via the API)
+        }
+
+    along with anything else github told us about the import. The statuses are
+    kept in a sqlite database in WAL mode, so that other processes can read it
+    while an import is running.
+
+    Writes are batched into a transaction, which is committed by flush().
+    """
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS import_status (
+                jira_key TEXT PRIMARY KEY,
+                status TEXT,
+                url TEXT,
+                issue_url TEXT,
+                data TEXT
+            )
+        """)
+        for column in ('status', 'url', 'issue_url'):
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS import_status_%s"
+                " ON import_status (%s)" % (column, column)
+            )
+        self._db.commit()
+
+    def get(self, jira_key, default=None):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT data FROM import_status WHERE jira_key = ?",
+                (jira_key,)
+            ).fetchone()
+        if row is None:
+            return default
+        return json.loads(row[0])
+
+    def __getitem__(self, jira_key):
+        r = self.get(jira_key)
+        if r is None:
+            raise KeyError(jira_key)
+        return r
+
+    def __setitem__(self, jira_key, issue_status):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO import_status"
+                " (jira_key, status, url, issue_url, data)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (jira_key, issue_status.get('status'),
+                 issue_status.get('url'), issue_status.get('issue_url'),
+                 json.dumps(issue_status)),
+            )
+
+    def keys(self, status=None):
+        """the jira keys of the issues, optionally only those with the given
+        status"""
+        return [k for (k, _) in self.items(status)]
+
+    def items(self, status=None):
+        query = "SELECT jira_key, data FROM import_status"
+        params = ()
+        if status is not None:
+            query += " WHERE status = ?"
+            params = (status,)
+        with self._lock:
+            rows = self._db.execute(query, params).fetchall()
+        return [(k, json.loads(v)) for (k, v) in rows]
+
+    def counts(self):
+        """returns a map from status to the number of issues in that state"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT status, COUNT(*) FROM import_status GROUP BY status"
+            ).fetchall()
+        return dict(rows)
+
+    def flush(self):
+        """commit any pending writes"""
+        with self._lock:
+            self._db.commit()
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+
+def open_status_db(data_dir):
+    """Open the state database in data_dir
+
+    If there is no sqlite database yet, but there is a status.db written by an
+    older version of import-github-issues.py with shelve, its contents are
+    copied into the new database.
+    """
+    path = os.path.join(data_dir, 'status.sqlite')
+    shelve_path = os.path.join(data_dir, 'status.db')
+    if not os.path.exists(path) and glob.glob(shelve_path + '*'):
+        logger.info("Migrating %s to %s", shelve_path, path)
+
+        # copy into a temporary database, and only move it into place once
+        # the copy is complete, so that if we fail part way the migration is
+        # tried again next time rather than leaving us with no statuses.
+        tmp_path = path + '.tmp'
+        for f in glob.glob(tmp_path + '*'):
+            os.remove(f)
+        db = StatusDb(tmp_path)
+        old = shelve.open(shelve_path, flag='r')
+        try:
+            for (k, v) in old.items():
+                db[k] = v
+        finally:
+            old.close()
+            db.close()
+        os.replace(tmp_path, path)
+
+    return StatusDb(path)
@@ -11,12 +11,12 @@
 
 import argparse
 import logging
-import os
-import os.path
 import re
 import yaml
 
-import requests
+import common
+import issue_store
+import mapping_db
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
@@ -30,30 +30,34 @@ parser.add_argument(
     '--data-dir', default='data',
     help='destination directory for exported issues. (default: %(default)s)'
 )
+parser.add_argument(
+    '--all', action='store_true',
+    help='check every issue on github, rather than just those whose exported '
+         'data mentions jira keys or links'
+)
+parser.add_argument(
+    '--bulk-comments', action='store_true',
+    help="list all the comments in each repository, rather than fetching each "
+         "issue's comments separately"
+)
+parser.add_argument(
+    '--since',
+    help='with --bulk-comments, only check comments updated at or after this '
+         'time (eg 2017-11-01T00:00:00Z)'
+)
 args = parser.parse_args()
 
 if args.debug:
     logging.getLogger().setLevel(logging.DEBUG)
 
 with open('config.yaml') as conf:
-    config = yaml.load(conf)
-
-mapping_file = os.path.join(args.data_dir, 'issue_mapping.yaml')
-with open(mapping_file) as f:
-    issue_mapping = yaml.load(f)
-
-github_session = requests.Session()
-github_session.headers.update({
-    'User-Agent': 'Jira issue import',
-    'Authorization': 'token ' + config['github_token'],
-})
-
-# compile a big regexp which matches any jira key
-jira_key_regex = re.compile(
-    r'(?<![\w\[])(' +  # don't match after a word character or [
-    '|'.join((re.escape(x) for x in config['jira_project_keys'])) +
-    r')-\d+(?!\w)'
-)
+    config = yaml.safe_load(conf)
+
+issue_mapping = mapping_db.open_mapping_db(args.data_dir)
+
+github_session = common.get_github_session(config)
+
+jira_key_regex = common.compile_jira_key_regex(config['jira_project_keys'])
 
 
 def map_jira_key(key):
@@ -70,30 +74,7 @@ def replace_jira_keys(text):
     returns (new: string, updated: boolean) where updated is True if a change
     was made
     """
-
-    idx = 0
-    updated = False
-    while True:
-        match = jira_key_regex.search(text, idx)
-        if not match:
-            return (text, updated)
-        s = match.start()
-
-        # logger.debug("got match %r after %s", match, text[s-7:s])
-
-        # don't replace if the previous text is 'browse/', because that means
-        # it's already linkified.
-        if s > 7 and text[s-7:s] == 'browse/':
-            idx = match.end()
-            continue
-
-        # looks like a real match. make a substitution
-        old = match.group()
-        new = map_jira_key(old)
-        logger.debug("%s -> %s", old, new)
-        text = text[:s] + new + text[match.end():]
-        updated = True
-        idx += len(new)
+    return common.replace_jira_keys(text, jira_key_regex, map_jira_key)
 
 
 def build_link_body(issue_data):
@@ -107,24 +88,49 @@ def build_link_body(issue_data):
     return comment
 
 
-issues = args.issue
-if issues is None:
-    issues = (
-        fname.replace('.yaml', '')
-        for fname in os.listdir(args.data_dir)
-        if re.match('[A-Z]+-[0-9]+\.yaml', fname)
+def index_issue(issue_data):
+    """Work out which parts of an imported issue might need updating
+
+    Returns (check_body: boolean, check_comments: boolean), which are False if
+    the exported data shows that there is nothing to update in the body or
+    comments respectively.
+    """
+    def mentions_keys(texts):
+        # use replace_jira_keys rather than just searching for keys, so that we
+        # skip the ones which are already linkified.
+        return any(replace_jira_keys(t)[1] for t in texts)
+
+    # the attachment links end up in the body
+    check_body = mentions_keys(
+        [issue_data['body']] + issue_data['attachments']
     )
 
-for issue_jira_key in issues:
-    logger.info("considering %s", issue_jira_key)
-    fname = os.path.join(args.data_dir, issue_jira_key+'.yaml')
+    # if there are links, there will be a placeholder comment to update
+    check_comments = bool(
+        issue_data['links'] or issue_data['remotelinks'] or
+        mentions_keys(c['body'] for c in issue_data['comments'])
+    )
+    return (check_body, check_comments)
 
-    issue_data = yaml.load(open(fname))
 
-    if issue_jira_key not in issue_mapping:
-        raise Exception('Issue %s not in issue mapping' % issue_jira_key)
-    issue_url = 'https://api.github.com/repos/' + issue_mapping[issue_jira_key]
+def update_comment(issue_jira_key, issue_data, comment):
+    if comment['body'] == 'JIRA LINK PLACEHOLDER':
+        newbody = build_link_body(issue_data)
+        updated = True
+    else:
+        (newbody, updated) = replace_jira_keys(comment['body'])
+
+    # update the comment
+    if updated:
+        logger.info("Updating comment %s on %s", comment['id'], issue_jira_key)
+        resp = github_session.patch(
+            comment['url'],
+            json={'body': newbody}
+        )
+        resp.raise_for_status()
+
 
+def update_issue_body(issue_jira_key, issue_url):
     # get the body of the issue to decide if we need to update it
     resp = github_session.get(issue_url)
     resp.raise_for_status()
@@ -145,23 +151,81 @@ for issue_jira_key in issues:
         )
         resp.raise_for_status()
 
-    # get the comments on this issue
-    resp = github_session.get(
-        issue_url+"/comments",
+
+store = issue_store.open_issue_store(args.data_dir)
+
+issues = args.issue
+if issues is None:
+    issues = (
+        k for k in store.keys() if re.match('[A-Z]+-[0-9]+$', k)
     )
-    resp.raise_for_status()
-    placeholder_issue_url = None
-    for comment in resp.json():
-        if comment['body'] == 'JIRA LINK PLACEHOLDER':
-            newbody = build_link_body(issue_data)
-            updated = True
-        else:
-            (newbody, updated) = replace_jira_keys(comment['body'])
-
-        # update the comment
-        if updated:
-            resp = github_session.patch(
-                comment['url'],
-                json={'body': newbody}
+
+# work out from the exported data which issues can possibly need updating, so
+# that we only fetch those from github.
+index = {}
+n_issues = 0
+closed = issue_store.closed_keys(args.data_dir)
+for issue_jira_key in issues:
+    if issue_jira_key not in issue_mapping:
+        # import-github-issues.py skips issues which were resolved after
+        # they were exported
+        if issue_jira_key in closed:
+            continue
+        raise Exception('Issue %s not in issue mapping' % issue_jira_key)
+
+    n_issues += 1
+    issue_data = store.get(issue_jira_key)
+
+    (check_body, check_comments) = index_issue(issue_data)
+    if args.all or check_body or check_comments:
+        index[issue_jira_key] = (
+            issue_data, args.all or check_body, args.all or check_comments,
+        )
+
+store.close()
+logger.info("%i of %i issues may need updating", len(index), n_issues)
+
+for issue_jira_key in sorted(index, key=common.sort_jira_key):
+    logger.info("considering %s", issue_jira_key)
+    (issue_data, check_body, check_comments) = index[issue_jira_key]
+    issue_url = 'https://api.github.com/repos/' + issue_mapping[issue_jira_key]
+
+    if check_body:
+        update_issue_body(issue_jira_key, issue_url)
+
+    if not check_comments or args.bulk_comments:
+        continue
+
+    # get the comments on this issue
+    for comment in github_session.paginate(issue_url + "/comments"):
+        update_comment(issue_jira_key, issue_data, comment)
+
+if args.bulk_comments:
+    # map from 'user/proj/issues/N' to jira key, for the issues whose comments
+    # we need to check
+    comment_issues = {
+        issue_mapping[k]: k for (k, v) in index.items() if v[2]
+    }
+    repos = sorted(set(p.split('/issues/')[0] for p in comment_issues))
+
+    params = {}
+    if args.since:
+        params['since'] = args.since
+
+    # stream the comments a page at a time, rather than holding every comment
+    # in the repository in memory.
+    for repo in repos:
+        logger.info("Listing comments in %s", repo)
+        comments = github_session.paginate(
+            'https://api.github.com/repos/%s/issues/comments' % repo, params,
+        )
+        for comment in comments:
+            p = comment['issue_url'].replace(
+                'https://api.github.com/repos/', ''
             )
-            resp.raise_for_status()
+            issue_jira_key = comment_issues.get(p)
+            if issue_jira_key is None:
+                continue
+            update_comment(issue_jira_key, index[issue_jira_key][0], comment)
+
+github_session.log_stats()